@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import OrderedDict
+
+from chord.util import distance
+
+
+class LookupCache:
+    """
+    LRU cache of the results of lookups started by this node.
+
+    When a lookup for a key returns a node, the node is responsible for every key from the looked up key up to its own
+    key. The cache keeps that key range per node, widening it as more keys resolve to the same node, so any key
+    inside a cached range is answered without network hops. Entries expire after ttl seconds.
+    """
+
+    def __init__(self, capacity: int, ttl: float):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict()  # node key -> (node, exclusive lower bound of the range, time stored)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.invalidations = 0
+
+    def get(self, key: int):
+        """Return the cached node responsible for key or None"""
+        now = time.time()
+        with self.lock:
+            for node_key, (node, low, stored) in list(self.entries.items()):
+                if not self._contains(low, node_key, key):
+                    continue
+                if now - stored > self.ttl:
+                    del self.entries[node_key]
+                    self.stale += 1
+                    break
+                self.entries.move_to_end(node_key)
+                self.hits += 1
+                return node
+            self.misses += 1
+            return None
+
+    def _contains(self, low: int, node_key: int, key: int) -> bool:
+        return 0 < distance(low, key) <= distance(low, node_key)
+
+    def put(self, key: int, node):
+        low = key - 1
+        stored = time.time()
+        with self.lock:
+            # Other nodes cached for this key are wrong, the ring has changed since they were stored
+            for node_key, (other, other_low, other_stored) in list(self.entries.items()):
+                if node_key != node.key and self._contains(other_low, node_key, key):
+                    del self.entries[node_key]
+                    self.invalidations += 1
+            if node.key in self.entries:
+                old_low, old_stored = self.entries[node.key][1:]
+                # A wider range is only as fresh as the oldest lookup backing it
+                if distance(old_low, node.key) > distance(low, node.key):
+                    low, stored = old_low, old_stored
+            self.entries[node.key] = (node, low, stored)
+            self.entries.move_to_end(node.key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, node_key: int):
+        with self.lock:
+            if self.entries.pop(node_key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'invalidations': self.invalidations}
+
+
+class SeenRequests:
+    """
+    Bounded set of the lookup request ids a node has forwarded recently, used to detect lookups running in a loop.
+    Ids are forgotten after expiry seconds, or when more than capacity ids are stored.
+    """
+
+    def __init__(self, capacity: int, expiry: float):
+        self.capacity = capacity
+        self.expiry = expiry
+        self.requests = OrderedDict()  # request id -> time seen
+        self.lock = threading.Lock()
+        self.loops = 0
+
+    def add(self, request_id: str) -> bool:
+        """Remember a request id, return False if it was already seen"""
+        now = time.time()
+        with self.lock:
+            while self.requests and now - next(iter(self.requests.values())) > self.expiry:
+                self.requests.popitem(last=False)
+            if request_id in self.requests:
+                self.loops += 1
+                return False
+            self.requests[request_id] = now
+            while len(self.requests) > self.capacity:
+                self.requests.popitem(last=False)
+            return True
+
+    def stats(self) -> dict:
+        return {'size': len(self.requests), 'loops': self.loops}
@@ -1,36 +1,106 @@
-import math
+import threading
+from bisect import bisect_left, bisect_right
 
-from config import INTERVAL
-
-from chord.util import in_interval
+from chord.util import RING_SIZE, distance
 
 
 class FingerTable:
+    """
+    Finger table of a node. All arithmetic is done on integers modulo RING_SIZE, so it is exact for identifier spaces
+    up to the full sha-256 hash.
+
+    Besides the fingers by index, the distinct finger nodes are kept sorted by their distance from our key, such that
+    the closest preceding finger of a key is found with a binary search. When a finger changes, its node is removed
+    from or inserted into the index at the position found by a binary search, instead of sorting the index again.
+    """
 
     def __init__(self, key):
         self.key = key
-        self.max_i = self.largest_power_of_2(math.pow(10, INTERVAL))
+        self.max_i = self.largest_power_of_2(RING_SIZE - 1)
         self.fingers = [None] * (self.max_i + 1)
         self.keys = [self.find_start(i) for i in range(0, self.max_i + 1)]
+        self._sorted = ([], [])  # sorted distances from our key to the finger nodes, and the nodes in that order
+        self._refs = {}  # key of a finger node -> number of fingers referring to it
+        # Serialises the updates of the fingers and the index, lookups read the index without it
+        self._lock = threading.Lock()
 
     @classmethod
-    def largest_power_of_2(cls, n: float) -> int:
+    def largest_power_of_2(cls, n: int) -> int:
         """Find the largest power of 2, which is used to determine the size of the finger table"""
-        return int(math.log2(n))
+        return n.bit_length() - 1
 
     def find_start(self, i) -> int:
-        return int((self.key + math.pow(2, i)) % math.pow(10, INTERVAL))
+        return (self.key + 2 ** i) % RING_SIZE
 
     def update_finger(self, i: int, node):
-        self.fingers[i] = node
+        with self._lock:
+            old = self.fingers[i]
+            self.fingers[i] = node
+            if old is not None:
+                self._index_remove(old)
+            if node is not None:
+                self._index_add(node)
+
+    def _index_add(self, node):
+        """Add a finger node to the sorted index, unless it is already in it"""
+        if node.key == self.key:
+            return
+        self._refs[node.key] = self._refs.get(node.key, 0) + 1
+        distances, nodes = self._sorted
+        d = distance(self.key, node.key)
+        j = bisect_left(distances, d)
+        if self._refs[node.key] > 1:
+            # Keep the newest node object of the key, it may carry a different address
+            nodes = nodes[:j] + [node] + nodes[j + 1:]
+        else:
+            distances = distances[:j] + [d] + distances[j:]
+            nodes = nodes[:j] + [node] + nodes[j:]
+        # Replaced in one assignment, lookups running in other threads see either the old or the new index
+        self._sorted = (distances, nodes)
+
+    def _index_remove(self, node):
+        """Remove a finger node from the sorted index once no finger refers to it any more"""
+        if node.key == self.key:
+            return
+        self._refs[node.key] -= 1
+        if self._refs[node.key] > 0:
+            return
+        del self._refs[node.key]
+        distances, nodes = self._sorted
+        j = bisect_left(distances, distance(self.key, node.key))
+        self._sorted = (distances[:j] + distances[j + 1:], nodes[:j] + nodes[j + 1:])
+
+    def _index(self):
+        """Rebuild the index from the fingers, the caller holds the lock"""
+        self._refs = {}
+        self._sorted = ([], [])
+        for node in self.fingers:
+            if node is not None:
+                self._index_add(node)
+
+    def preceding_fingers(self, key: int) -> list:
+        """Return the distinct finger nodes between our key and key, without passing it, ordered by distance"""
+        distances, nodes = self._sorted
+        # Our own key is a full round of the ring away
+        return nodes[:bisect_right(distances, distance(self.key, key) or RING_SIZE)]
 
     def closest_preceding_finger(self, key: int):
-        for i in range(self.max_i, -1, -1):
-            if in_interval(self.key, key, self.keys[i]):
-                if not self.fingers[i]:
-                    continue
-                return self.fingers[i]
-        return None
+        """Return the finger node closest to key, without passing it, or None"""
+        nodes = self.preceding_fingers(key)
+        return nodes[-1] if nodes else None
+
+    def seed(self, nodes: list):
+        """
+        Fill the table from a list of known nodes, e.g. the finger table of a neighbour. Every finger is set to the
+        first node at or after its start, which is correct if the list contains all the nodes in between.
+        """
+        nodes = [x for x in nodes if x is not None]
+        if not nodes:
+            return
+        with self._lock:
+            for i in range(0, self.max_i + 1):
+                self.fingers[i] = min(nodes, key=lambda node: distance(self.keys[i], node.key))
+            self._index()
 
     def finger_has_empty_index(self):
         if None in self.fingers:
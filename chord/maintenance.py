@@ -0,0 +1,170 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MaintenanceTask:
+    """
+    A periodic maintenance job of a node, e.g. stabilize or collect_data.
+
+    If the task is given an observe function, the interval is adaptive: it is multiplied by backoff after every run
+    where the observed state did not change (up to max_interval), and reset to the base interval when the state
+    changes, the task fails or the engine is reset. A change seen by one adaptive task resets all of them.
+    """
+
+    def __init__(self, name: str, func, interval: float, jitter: float = 0.0, concurrency: int = 1,
+                 observe=None, backoff: float = 1, max_interval: float = None):
+        self.name = name
+        self.func = func
+        self.base_interval = interval
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.observe = observe
+        self.backoff = backoff
+        self.max_interval = max_interval or interval
+        self.last_state = None
+        self.changes = deque(maxlen=20)
+        self.wake = None
+        self.run_now = False
+        self.runs = 0
+        self.failures = 0
+        self.running = 0
+        self.last_duration = None
+
+    def adapt(self, failed: bool) -> bool:
+        """Adjust the interval after a run, returns True if the observed state changed or the run failed"""
+        if self.observe is None:
+            return False
+        state = self.observe()
+        changed = failed or state != self.last_state
+        self.last_state = state
+        self.changes.append(changed)
+        if changed:
+            self.interval = self.base_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        return changed
+
+    def reset(self):
+        self.interval = self.base_interval
+
+    def change_rate(self) -> float:
+        """Fraction of the recent runs where the observed state changed"""
+        if not self.changes:
+            return 0.0
+        return round(sum(self.changes) / len(self.changes), 3)
+
+    def stats(self) -> dict:
+        return {'interval': self.interval,
+                'change_rate': self.change_rate(),
+                'concurrency': self.concurrency,
+                'running': self.running,
+                'runs': self.runs,
+                'failures': self.failures,
+                'last_duration': self.last_duration}
+
+
+class MaintenanceEngine:
+    """
+    Run the maintenance tasks of a node from an asyncio event loop in a background thread.
+
+    Every task is scheduled independently with its own interval and concurrency limit. The task functions are
+    blocking, so they are executed on a thread pool which is sized such that a slow task can never take the
+    workers of another task.
+    """
+
+    def __init__(self):
+        self.tasks = {}
+        self.loop = asyncio.new_event_loop()
+        self.executor = None
+        self.thread = None
+
+    def add_task(self, name: str, func, interval: float, jitter: float = 0.0, concurrency: int = 1,
+                 observe=None, backoff: float = 1, max_interval: float = None):
+        self.tasks[name] = MaintenanceTask(name, func, interval, jitter, concurrency, observe, backoff, max_interval)
+
+    def start(self):
+        workers = sum(task.concurrency for task in self.tasks.values())
+        self.executor = ThreadPoolExecutor(max(workers, 1))
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        for task in self.tasks.values():
+            self.loop.call_soon_threadsafe(self.loop.create_task, self._schedule(task))
+
+    def reset(self, run_now: bool = True):
+        """
+        Put all adaptive tasks back to their base interval and wake them up, such that they run right away or, without
+        run_now, sleep at most the base interval from their last run. Safe to call from any thread.
+        """
+        for task in self.tasks.values():
+            if task.observe is None:
+                continue
+            task.reset()
+            if task.wake is not None:
+                self.loop.call_soon_threadsafe(self._wake, task, run_now)
+
+    def _wake(self, task: MaintenanceTask, run_now: bool):
+        task.run_now = task.run_now or run_now
+        task.wake.set()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    async def _schedule(self, task: MaintenanceTask):
+        semaphore = asyncio.Semaphore(task.concurrency)
+        task.wake = asyncio.Event()
+        while True:
+            # Wait for a free slot, so a task never has more than `concurrency` runs in flight
+            await semaphore.acquire()
+            future = self.loop.run_in_executor(self.executor, self._run, task)
+            future.add_done_callback(lambda f: semaphore.release())
+            await self._sleep(task, self.loop.time(), random.uniform(0, task.jitter))
+
+    async def _sleep(self, task: MaintenanceTask, started: float, jitter: float):
+        """
+        Sleep until the interval of a task has passed since started. When the task is woken up the interval is read
+        again, as it may have been reset while sleeping, and the task runs right away if run_now is set.
+        """
+        while True:
+            task.wake.clear()
+            remaining = started + task.interval + jitter - self.loop.time()
+            if task.run_now or remaining <= 0:
+                task.run_now = False
+                return
+            try:
+                await asyncio.wait_for(task.wake.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    def _run(self, task: MaintenanceTask):
+        task.running += 1
+        start = time.time()
+        failed = False
+        try:
+            task.func()
+        except Exception as e:
+            failed = True
+            task.failures += 1
+            print('[Maintenance] {0} failed: {1}'.format(task.name, e))
+        finally:
+            task.running -= 1
+            task.runs += 1
+            task.last_duration = round(time.time() - start, 3)
+        try:
+            changed = task.adapt(failed)
+        except Exception as e:
+            print('[Maintenance] {0} could not observe state: {1}'.format(task.name, e))
+            return
+        if changed:
+            # The ring is changing, so every adaptive task goes back to its base interval, including the sleep
+            # of this task which started before the run finished
+            self.reset(run_now=False)
+
+    def stats(self) -> dict:
+        return {name: task.stats() for name, task in self.tasks.items()}
@@ -1,16 +1,45 @@
 
 
-from chord.util import encode_address, encode_key, in_interval
+from chord.util import RING_SIZE, distance, encode_address, encode_key, in_interval
 from chord.finger_table import FingerTable
 from chord.photon import Photon, PhotonBackup
-from datetime import datetime
-import requests
+from chord.transport import Transport
+from chord.cache import LookupCache, SeenRequests
+from chord.rollup import downsample, merge
+from concurrent.futures import ThreadPoolExecutor, wait
 import json
+import math
 import random
+import requests
+import threading
 import time
-import sqlite3 as sql
+import uuid
+import zlib
 
-from config import INTERVAL, SUCCESSOR_LIST_SIZE
+from config import (
+    SUCCESSOR_LIST_SIZE,
+    LOOKUP_MAX_HOPS,
+    LOOKUP_CACHE_SIZE,
+    LOOKUP_CACHE_TTL,
+    LOOKUP_REQUESTS_EXPIRY,
+    LOOKUP_REQUESTS_SIZE,
+    LOOKUP_SLOW_ATTEMPTS,
+    LOOKUP_SLOW_DEADLINE,
+    FAILED_HOP_EXPIRY,
+    PROXIMITY_ROUTING,
+    COLLECT_WORKERS,
+    FINGER_WORKERS,
+    FINGER_REPAIR,
+    REPLICATION_BATCH,
+    REPLICATION_FACTOR,
+    HANDOFF_BATCH,
+    HANDOFF_TIMEOUT,
+    REPLICATION_PUSH,
+    PUSH_GRACE,
+    GRAPH_POINTS,
+    ROUTE_TIMEOUT,
+    AGGREGATE_MARGIN
+)
 
 
 class Node:
@@ -18,6 +47,11 @@ class Node:
     Class representing a peer in the network
     """
 
+    # All nodes in the process share one pooled keep-alive transport for their RPCs
+    transport = Transport()
+    # Photons are sampled through a separate pool, without retries, so the particle cloud does not skew RPC counters
+    cloud_transport = Transport(retries=0, pool_size=COLLECT_WORKERS)
+
     def __init__(self, ip: str, port: int):
         self.ip = ip
         self.port = port
@@ -26,12 +60,30 @@ class Node:
         self.predecessor = None
         self.successor_list = []
         self.successor_list_index_update = 0
+        # Guards the successor, predecessor and successor list, which are updated by several maintenance tasks and
+        # RPC handlers. It is never held during a request to another node.
+        self.ring_lock = threading.RLock()
+        # Held by a collect_data pass until its measurements are stored
+        self.collect_lock = threading.Lock()
         self.finger_table = FingerTable(self.key)
-        self.last_request_key = None
-        self.last_request_owner = []
+        self.lookup_cache = LookupCache(LOOKUP_CACHE_SIZE, LOOKUP_CACHE_TTL)
+        self.seen_requests = SeenRequests(LOOKUP_REQUESTS_SIZE, LOOKUP_REQUESTS_EXPIRY)
         self.finger_index_update = 0
+        self.ring_failures = 0
+        # Keys of finger nodes which failed to answer a forwarded lookup -> time of the failure. They are skipped as
+        # hops until they answer again, a finger repair finds them alive or FAILED_HOP_EXPIRY seconds have passed.
+        self.failed_hops = {}
+        self.finger_stats = {'runs': 0, 'lookups': 0, 'deduplicated': 0, 'failed': 0}
+        # How lookups forwarded by this node were resolved, and why the slow path failed
+        self.lookup_stats = {'fingers': 0, 'slow': 0, 'slow_attempts': 0, 'failed': 0, 'reasons': {}}
+        self.route_stats = {'queries': 0, 'local': 0, 'fallbacks': 0, 'failed': 0}
         self.photons = []
         self.photon_backup = []
+        self.storage = None
+        self.collect_stats = {'passes': 0, 'photons': 0, 'collected': 0, 'failures': 0, 'duration': None}
+        self.push_stats = {'pushed': 0, 'acked': 0, 'failed': 0, 'received': 0, 'rejected': 0}
+        self.handoff_stats = {'photons': 0, 'rows': 0, 'bytes': 0, 'duration': None,
+                              'rows_per_second': None, 'bytes_per_second': None}
 
     def _make_successor_request(self, node: 'Node', key: int, start_key: int = None) -> 'Node':
         """Make a request to a node go get the successor responsible for a key"""
@@ -43,7 +95,7 @@ class Node:
         else:
             url = 'http://{0}:{1}/successor'.format(node.ip, node.port)
         try:
-            data = json.loads(requests.get(url).text)
+            data = json.loads(self.transport.get(url, measure=not key).text)
         except:
             return None
         if data is not None:
@@ -54,155 +106,486 @@ class Node:
     def get_key(self) -> int:
         return self.key
 
-    def _use_fingertable(self, key: int, start_key: int, count: int):
-        # If we have already seen this request key it means
-        # that we are in an endless loop and we need to get out
-        # Push the job to our successor
-        if start_key in self.last_request_owner or key == self.last_request_key:
-            # return self._make_successor_request(self.successor, key), "Start key {0} same as last request key".format(
-            #    start_key)
-            return None, "Start key {0} same as last request key".format(start_key), count
-        self.last_request_key = key
-        self.last_request_owner.append(start_key)
-
-        # The key is not in our interval so we forward the request
-        # to the best fitting peer in our finger table.
-        # Find the peer closest in the finger table
-        node = self.closest_preceding_finger(key)
-
-        # if for some reason the finger table returns our own key,
-        # forward the call to the successor as we have already
-        # verified that we are not done (key is not in our interval)
-        if node.key == self.key:
-            # return self._make_successor_request(self.successor, key), "Finger table returned own key: {0}".format(
-            #    node.key)
-            return None, "Finger table returned own key: {0}".format(node.key), count
+    def _successor_url(self, node: 'Node', key: int, start_key: int, count: int, request_id: str, ttl: int) -> str:
+        return 'http://{0}:{1}/successor/{2}/{3}/{4}?rid={5}&ttl={6}'.format(node.ip, node.port, key, start_key,
+                                                                           count + 1, request_id, ttl - 1)
 
-        # Request find_successor on this peer
-        url = 'http://{0}:{1}/successor/{2}/{3}/{4}'.format(node.ip, node.port, key, start_key, count+1)
+    def _request_lookup(self, url: str, timeout: float = None) -> (dict, str):
+        """Send one hop of a lookup, return (answer, None) or (None, reason of the failure)"""
+        read_timeout = self.transport.timeout[1] if timeout is None else min(self.transport.timeout[1], timeout)
         try:
             print("[{1}] Successor request: {0}".format(url, self.port))
-            data = json.loads(requests.get(url).text)
-        except:
-            return None, "Failed Request (except)"
-        if data is not None:
-            if data['successor'] is True:
-                print('[{1}] Node key returned: {0}'.format(node.key, self.port))
-                return Node(data['ip'], data['port']), "Success request", data['count']
-            if data['successor'] is False:
-                return None, data['error'], count
-        return None, "Request data None", count
-
-    def _slow_successor(self, key: int, start_key: int, count: int):
-        url = 'http://{0}:{1}/successor/{2}/{3}/{4}'.format(self.successor.ip, self.successor.port, key, start_key, count+1)
+            data = json.loads(self.transport.get(url, measure=False,
+                                                 timeout=(self.transport.timeout[0], read_timeout)).text)
+        except requests.exceptions.Timeout:
+            return None, 'timeout'
+        except requests.exceptions.RequestException:
+            return None, 'unreachable'
+        except ValueError:
+            return None, 'bad_response'
+        if not isinstance(data, dict):
+            return None, 'bad_response'
+        return data, None
+
+    def _run_lookup(self, steps) -> ('Node', str, int):
+        """Drive the steps of lookup() with blocking requests"""
         try:
-            print("[{1}][Slow] Successor request: {0}".format(url, self.port))
-            data = json.loads(requests.get(url).text)
-        except:
-            # Try another successor from the lst
-            self.set_new_successor()
-            return self._slow_successor(key, start_key)
-        if data is not None:
-            if data['successor'] is True:
-                node = Node(data['ip'], data['port'])
-                print('[{1}][Slow] Node key returned: {0}'.format(node.key, self.port))
-                return node, "[Slow] Success request", data['count']
-            if data['successor'] is False:
-                return None, data['error'], count
-        return None, "[Slow] Request data None", count
-
-    def find_successor(self, key: int, start_key: int, count: int=0, use_fingers=True) -> ('Node', str):
-        msg = ""
+            node, url, timeout = next(steps)
+            while True:
+                node, url, timeout = steps.send(self._request_lookup(url, timeout))
+        except StopIteration as e:
+            return e.value
+
+    def slow_candidates(self) -> list:
+        """The distinct nodes of the successor list, starting with the successor, which the slow path forwards to"""
+        candidates = []
+        for node in [self.successor] + self.successor_list:
+            if node.key != self.key and node.key not in [c.key for c in candidates]:
+                candidates.append(node)
+        return candidates
 
+    def resolve_locally(self, key: int):
+        """Return (node, msg) if we know the node responsible for key without asking other nodes, otherwise None"""
         # Check if the key is between us an our successor.
         # If that is the case we are done and can return the
         # successor.
         if in_interval(self.key, self.successor.key, key):
-            return self.successor, "Found using self successor", count
+            return self.successor, "Found using self successor"
         # Also check the predecessor
         if self.predecessor is not None:
             if in_interval(self.predecessor.key, self.key, key):
-                return Node(self.ip, self.port), "Found using self predecessor", count
+                return Node(self.ip, self.port), "Found using self predecessor"
+        return None
+
+    def _slow_failure(self, reasons: list, error: str=None) -> str:
+        for reason, node in reasons:
+            self.lookup_stats['reasons'][reason] = self.lookup_stats['reasons'].get(reason, 0) + 1
+        msg = "[Slow] Failed: " + ", ".join("{0} {1}".format(reason, node) for reason, node in reasons)
+        if error:
+            msg += " ({0})".format(error)
+        return msg
+
+    def find_successor(self, key: int, start_key: int, count: int=0, use_fingers=True, iterative=False,
+                       request_id: str=None, ttl: int=LOOKUP_MAX_HOPS) -> ('Node', str):
+        # Iterative lookups are driven by the originating node, one hop at a time
+        if iterative and start_key == self.key and self.resolve_locally(key) is None:
+            cached = self.lookup_cache.get(key)
+            if cached is not None:
+                return cached, "Found in lookup cache", count
+            node, msg, count, hops = self.find_successor_iterative(key)
+            if node is not None:
+                self.lookup_cache.put(key, node)
+            return node, msg + " (hop latencies ms: {0})".format(hops), count
+        return self._run_lookup(self.lookup(key, start_key, count, use_fingers, request_id, ttl))
+
+    def lookup(self, key: int, start_key: int, count: int=0, use_fingers=True, request_id: str=None,
+               ttl: int=LOOKUP_MAX_HOPS):
+        """
+        The decisions of a recursive lookup, without doing any requests, such that the blocking find_successor and
+        the asyncio server share them. Every hop is yielded as (node, url, timeout), where timeout is None for the
+        default read timeout, and the caller sends back (answer, None), or (None, reason) if the request failed
+        with 'timeout', 'unreachable' or 'bad_response'.
+
+        :return: (node, msg, count) with node None if the lookup failed
+        """
+        msg = ""
+        # Every lookup carries its own id for loop detection, and a ttl bounding the number of hops
+        if request_id is None:
+            request_id = uuid.uuid4().hex
+
+        local = self.resolve_locally(key)
+        if local is not None:
+            return local[0], local[1], count
+
+        # Keys we resolved recently do not need any hops. Only lookups started here use the cache, such that a
+        # stale entry can not spread to the caches of other nodes.
+        use_cache = start_key == self.key
+        cached = self.lookup_cache.get(key) if use_cache else None
+        if cached is not None:
+            return cached, "Found in lookup cache", count
+
+        if ttl <= 0:
+            return None, "Request {0} exceeded the hop limit".format(request_id), count
 
         # Trying finger tables first if enabled
         if use_fingers:
-            finger_result, msg, finger_count = self._use_fingertable(key, start_key, count)
-            if finger_result is not None:
-                return finger_result, msg, finger_count
+            # If we have already forwarded this request it means that we are in an endless loop and we need to get
+            # out, the request is pushed to our successor
+            if not self.seen_requests.add(request_id):
+                msg = "Request {0} already forwarded by this node".format(request_id)
+            else:
+                # The key is not in our interval so we forward the request to the best fitting peer in our finger
+                # table. If for some reason the finger table returns our own key, the call goes to the successor as
+                # we have already verified that we are not done.
+                node = self.closest_preceding_finger(key)
+                msg = "Finger table returned own key: {0}".format(node.key)
+                if node.key != self.key:
+                    data, reason = yield node, self._successor_url(node, key, start_key, count, request_id, ttl), None
+                    if reason is not None:
+                        self.failed_hops[node.key] = time.time()
+                        self.lookup_cache.invalidate(node.key)
+                        msg = "Failed Request (except)"
+                    else:
+                        self.failed_hops.pop(node.key, None)
+                        if data.get('successor') is True:
+                            print('[{1}] Node key returned: {0}'.format(node.key, self.port))
+                            result = Node(data['ip'], data['port'])
+                            self.lookup_stats['fingers'] += 1
+                            if use_cache:
+                                self.lookup_cache.put(key, result)
+                            return result, "Success request", data['count']
+                        msg = data.get('error')
+
+        # Finger table did not return a result or is not enabled. The lookup is forwarded to the successor, falling
+        # back to the next nodes of the successor list if it does not answer. At most LOOKUP_SLOW_ATTEMPTS nodes are
+        # tried within LOOKUP_SLOW_DEADLINE seconds. The successor itself is not changed here, that is left to
+        # stabilize.
+        candidates = self.slow_candidates()
+        deadline = time.time() + LOOKUP_SLOW_DEADLINE
+        reasons = []
+        for node in candidates[:LOOKUP_SLOW_ATTEMPTS]:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                reasons.append(('deadline', node))
+                break
+            self.lookup_stats['slow_attempts'] += 1
+            data, reason = yield node, self._successor_url(node, key, start_key, count, request_id, ttl), remaining
+            if reason is not None:
+                reasons.append((reason, node))
+                continue
+            self.failed_hops.pop(node.key, None)
+            if data.get('successor') is True:
+                result = Node(data['ip'], data['port'])
+                print('[{1}][Slow] Node key returned: {0}'.format(result.key, self.port))
+                self.lookup_stats['slow'] += 1
+                if use_cache:
+                    self.lookup_cache.put(key, result)
+                return result, "[Slow] Success request : " + msg, data['count']
+            # The node answered but could not resolve the key, asking the next one would only repeat the lookup
+            reasons.append(('remote_error', node))
+            self.lookup_stats['failed'] += 1
+            return None, "Everything failed (returned None): " + self._slow_failure(reasons, data.get('error')) + \
+                " : " + msg, count
+        if not reasons:
+            reasons.append(('no_successor', self))
+        elif len(reasons) == LOOKUP_SLOW_ATTEMPTS and len(candidates) > LOOKUP_SLOW_ATTEMPTS:
+            reasons.append(('budget', self))
+        self.lookup_stats['failed'] += 1
+        return None, "Everything failed (returned None): " + self._slow_failure(reasons) + " : " + msg, count
+
+    def find_successor_iterative(self, key: int) -> ('Node', str, int, list):
+        """
+        Resolve a key by walking the ring from this node, asking each hop only for its closest preceding finger
 
-        # Finger table did not return a result or is not enabled
-        # Trying slow method to move forward
-        slow_result, msg_slow, slow_count = self._slow_successor(key, start_key, count)
-        if slow_result is not None:
-            return slow_result, msg_slow + " : " + msg, slow_count
+        :param key: the key to search for
+        :return: (node, msg, hop count, list of per-hop latencies in ms)
+        """
+        hops = []
+        current = self
+        for _ in range(0, LOOKUP_MAX_HOPS):
+            if current.key == self.key:
+                if in_interval(self.key, self.successor.key, key):
+                    return self.successor, "[Iterative] Found using self successor", len(hops), hops
+                if self.predecessor is not None and in_interval(self.predecessor.key, self.key, key):
+                    return Node(self.ip, self.port), "[Iterative] Found using self predecessor", len(hops), hops
+                next_node = self.closest_preceding_finger(key)
+                succ = self.successor
+            else:
+                url = 'http://{0}:{1}/closest_finger/{2}'.format(current.ip, current.port, key)
+                start = time.time()
+                try:
+                    data = json.loads(self.transport.get(url).text)
+                except:
+                    return None, "[Iterative] Failed request to {0}".format(current), len(hops), hops
+                hops.append(round((time.time() - start) * 1000, 2))
+                succ = Node(data['successor_ip'], data['successor_port'])
+                if data['done']:
+                    return succ, "[Iterative] Success request", len(hops), hops
+                next_node = Node(data['node_ip'], data['node_port'])
 
-        return None, "Everything failed (returned None): " + msg_slow + " : " + msg, count
+            if next_node.key == key:
+                return next_node, "[Iterative] Success request", len(hops), hops
+            # The finger must make progress without passing the key, otherwise step to the successor
+            if not in_interval(current.key, key, next_node.key):
+                next_node = succ
+            current = next_node
+        return None, "[Iterative] Hop budget of {0} exhausted".format(LOOKUP_MAX_HOPS), len(hops), hops
 
     def closest_preceding_finger(self, key):
         print('{1}: Searching finger table for key: {0}'.format(key, self.port))
-        node = self.finger_table.closest_preceding_finger(key)
+        node = self.closest_preceding_node(key) if PROXIMITY_ROUTING else None
+        if node is None:
+            node = self.finger_table.closest_preceding_finger(key)
         if node is not None:
             print('{3}: Found node: {0} ({1}) while searching for {2}'.format(node.key, node.port, key, self.port))
             return node
         print('Did not find any match in the finger table...')
         return self
 
+    def hop_failed(self, key: int) -> bool:
+        """Return whether the node with key failed to answer a forwarded lookup in the last FAILED_HOP_EXPIRY seconds"""
+        failed = self.failed_hops.get(key)
+        if failed is None:
+            return False
+        if time.time() - failed > FAILED_HOP_EXPIRY:
+            self.failed_hops.pop(key, None)
+            return False
+        return True
+
+    def closest_preceding_node(self, key: int):
+        """
+        Choose the next hop towards a key among the fingers and the successor list, by estimated lookup latency.
+
+        Every known node between us and the key makes progress. For each of them the remaining hops are estimated
+        from the key distance left, assuming nodes are spread as evenly as our successor list, and the cost is the
+        measured round trip time to the node plus the average round trip time for each of the remaining hops.
+        Without any measurements this picks the node closest to the key, as the finger table does.
+
+        :return: the chosen node, or None if no known node precedes the key
+        """
+        # The finger table index already holds the fingers preceding the key, only the successors are checked
+        successors = [x for x in [self.successor] + self.successor_list
+                      if x is not None and x.key != self.key and in_interval(self.key, key, x.key)]
+        candidates = {}
+        for node in self.finger_table.preceding_fingers(key) + successors:
+            if not self.hop_failed(node.key):
+                candidates[node.key] = node
+        if not candidates:
+            return None
+
+        rtts = {k: self.transport.rtt(node.ip, node.port) for k, node in candidates.items()}
+        measured = [rtt for rtt in rtts.values() if rtt is not None]
+        average = sum(measured) / len(measured) if measured else 0
+        spread = self.successor_list or [self.successor]
+        spacing = max(distance(self.key, spread[-1].key) / len(spread), 1)
+
+        def cost(node):
+            hops = math.log2(1 + distance(node.key, key) / spacing)
+            rtt = rtts[node.key] if rtts[node.key] is not None else average
+            return rtt + average * hops, distance(node.key, key)
+
+        return min(candidates.values(), key=cost)
+
     def join(self, ip: str, port: int):
         # Join the peer with the id to the chord-network
-        self.predecessor = None
         while True:
             print("[{0}] Trying to join: {1}".format(self.port, port))
-            self.successor = self._make_successor_request(Node(ip, port), self.key)
-            if self.successor is not None:
+            successor = self._make_successor_request(Node(ip, port), self.key)
+            if successor is not None:
                 print("[{0}] Joined".format(self.port))
                 break
             print("[{0}] Sleeping...".format(self.port))
             time.sleep(5)
 
-        self.finger_table.update_finger(0, self.successor)
-        self.successor_list = []
+        with self.ring_lock:
+            self.predecessor = None
+            self.successor = successor
+            self.finger_table.update_finger(0, self.successor)
+            self.successor_list = []
         self.stabilize()
+        self.bootstrap_fingers()
         self.get_photons_from_successor()
 
+    def bootstrap_fingers(self):
+        """
+        Copy the finger tables of our neighbours instead of starting with an empty table, and verify the result with
+        parallel lookups. Our fingers start just after the successor's, so its table covers most of ours.
+        """
+        nodes = [self.successor]
+        for neighbour in (self.successor, self.predecessor):
+            if neighbour is None or neighbour.key == self.key:
+                continue
+            try:
+                url = 'http://{0}:{1}/finger_table'.format(neighbour.ip, neighbour.port)
+                data = json.loads(self.transport.get(url).text)
+            except:
+                continue
+            nodes.append(neighbour)
+            nodes.extend(Node(x['ip'], x['port']) for x in data['fingers'] if x is not None)
+        self.finger_table.seed([x for x in nodes if x.key != self.key] or [self.successor])
+        self.finger_table.update_finger(0, self.successor)
+        self.fix_all_fingers()
+
+    def lookup_fingers(self, indices: list) -> dict:
+        """Look up the fingers with the given indices concurrently, update them and return {index: node}"""
+        result = {}
+        if not indices:
+            return result
+        with ThreadPoolExecutor(min(FINGER_WORKERS, len(indices))) as pool:
+            lookups = pool.map(lambda i: self.find_successor(self.finger_table.keys[i], self.key), indices)
+            for i, (node, msg, count) in zip(indices, lookups):
+                self.finger_stats['lookups'] += 1
+                if node is None:
+                    self.finger_stats['failed'] += 1
+                    continue
+                self.finger_table.update_finger(i, node)
+                result[i] = node
+        return result
+
+    def fix_all_fingers(self):
+        """
+        Refresh the whole finger table with concurrent lookups. Consecutive fingers pointing to the same node are
+        looked up once, the result is reused for the other starts if they are still in front of that node. Fingers
+        which are empty or recently failed a hop are looked up first.
+        """
+        table = self.finger_table
+        groups = []
+        for i in range(0, table.max_i + 1):
+            finger = table.fingers[i]
+            previous = table.fingers[groups[-1][0]] if groups else None
+            if finger is not None and previous is not None and finger.key == previous.key:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        groups.sort(key=lambda g: table.fingers[g[0]] is not None and not self.hop_failed(table.fingers[g[0]].key))
+
+        first = self.lookup_fingers([g[0] for g in groups])
+        rest = []
+        for group in groups:
+            node = first.get(group[0])
+            for i in group[1:]:
+                # No node lies between the first start and its successor, so starts in between share it
+                if node is not None and in_interval(table.keys[group[0]], node.key, table.keys[i]):
+                    table.update_finger(i, node)
+                    self.finger_stats['deduplicated'] += 1
+                else:
+                    rest.append(i)
+        second = self.lookup_fingers(rest)
+
+        if len(first) + len(second) < len(groups) + len(rest):
+            self.ring_failures += 1
+        alive = set(x.key for x in list(first.values()) + list(second.values()))
+        fingers = set(x.key for x in table.fingers if x is not None)
+        self.failed_hops = {k: t for k, t in list(self.failed_hops.items()) if k in fingers and k not in alive}
+        self.finger_stats['runs'] += 1
+
     def leave(self):
-        self.predecessor = None
-        self.successor = self
-        self.successor_list = []
+        with self.ring_lock:
+            self.predecessor = None
+            self.successor = self
+            self.successor_list = []
 
-    def notify(self, node: 'Node'):
-        if not self.predecessor or in_interval(self.predecessor.key, self.key, node.key):
-            self.predecessor = node
+    def depart(self) -> bool:
+        """
+        Leave the network gracefully. The photons are handed over to the successor, which also pulls the measurements
+        it does not have yet, and the predecessor and successor are told to link up with each other.
 
-    def stabilize(self):
-        # clear last request key
-        self.last_request_key = None
-        self.last_request_owner = []
+        :return: False if the successor could not take over the photons, in which case we stay in the network
+        """
+        if self.successor is None or self.successor.key == self.key:
+            self.leave()
+            return True
+        successor = self.successor
+        predecessor = self.predecessor
 
-        if self.key != self.successor.key:
+        # Stop collecting before the handoff, such that the successor gets every measurement. A pass which is
+        # already running is waited for.
+        with self.collect_lock:
+            photons = self.photons
+            self.photons = []
+        try:
+            url = 'http://{0}:{1}/take_photons'.format(successor.ip, successor.port)
+            response = self.transport.post(url, json={'ip': self.ip, 'port': self.port,
+                                                      'photon_ids': [x.photon_id for x in photons]},
+                                           timeout=(self.transport.timeout[0], HANDOFF_TIMEOUT))
+            if not response.json()['success']:
+                raise Exception(response.json()['msg'])
+        except Exception as e:
+            print('[{0}] Could not hand over photons to {1}: {2}'.format(self.port, successor, e))
+            self.photons = photons + self.photons
+            return False
+
+        data = {'ip': self.ip, 'port': self.port, 'successor_ip': successor.ip, 'successor_port': successor.port}
+        if predecessor is not None:
+            data['predecessor_ip'] = predecessor.ip
+            data['predecessor_port'] = predecessor.port
+        for node in (predecessor, successor):
+            if node is None:
+                continue
+            try:
+                url = 'http://{0}:{1}/leaving'.format(node.ip, node.port)
+                self.transport.post(url, data=data)
+            except:
+                pass
+
+        print('[{0}] Left the network, photons handed over to {1}'.format(self.port, successor))
+        self.photon_backup = []
+        self.leave()
+        return True
+
+    def take_photons(self, node: 'Node', photon_ids: list):
+        """Become master of the photons of a leaving node and pull their measurements from it"""
+        known = [x.photon_id for x in self.photons]
+        photons = [Photon(photon_id) for photon_id in photon_ids if photon_id not in known]
+        self.fetch_handoff(node, [x.key for x in photons])
+        # Only collect once the history is stored, such that new measurements are numbered after it
+        self.photons.extend(photons)
+        self.photon_backup = [x for x in self.photon_backup if x.photon_id not in photon_ids]
+
+    def handle_leaving(self, node: 'Node', successor: 'Node', predecessor: 'Node'):
+        """Remove a leaving node from our pointers, replacing it with its successor or predecessor"""
+        self.lookup_cache.clear()
+        with self.ring_lock:
+            if self.successor is not None and self.successor.key == node.key:
+                self.successor = successor
+            self.successor_list = [x for x in self.successor_list if x.key != node.key]
+            for i, finger in enumerate(self.finger_table.fingers):
+                if finger is not None and finger.key == node.key:
+                    self.finger_table.update_finger(i, successor)
+            self.finger_table.update_finger(0, self.successor)
+            if self.predecessor is not None and self.predecessor.key == node.key:
+                self.predecessor = predecessor
+
+    def notify(self, node: 'Node') -> bool:
+        """Consider node as new predecessor, return True if the predecessor changed"""
+        with self.ring_lock:
+            if not self.predecessor or in_interval(self.predecessor.key, self.key, node.key):
+                changed = self.predecessor is None or self.predecessor.key != node.key
+                self.predecessor = node
+                if changed:
+                    self.lookup_cache.clear()
+                return changed
+        return False
+
+    def stabilize(self):
+        old_successor = self.successor
+        if self.key != old_successor.key:
             x = None
 
             # Request successor for it's predecessor
-            url = 'http://{0}:{1}/predecessor'.format(self.successor.ip, self.successor.port)
+            url = 'http://{0}:{1}/predecessor'.format(old_successor.ip, old_successor.port)
             try:
-                data = json.loads(requests.get(url).text)
+                data = json.loads(self.transport.get(url).text)
             except:
-                self.set_new_successor()
+                self.ring_failures += 1
+                self.set_new_successor(old_successor)
                 data = None
 
             if data is not None:
                 if data['predecessor']:
                     x = Node(data['ip'], data['port'])
 
-            if x and in_interval(self.key, self.successor.key, x.key):
-                self.successor = x
+            with self.ring_lock:
+                # Another task may have replaced the successor while we were waiting for its answer
+                if x and self.successor.key == old_successor.key and in_interval(self.key, self.successor.key, x.key):
+                    self.successor = x
+                successor = self.successor
 
-            url = 'http://{0}:{1}/notify'.format(self.successor.ip, self.successor.port)
-            requests.post(url, data={'ip': self.ip, 'port': self.port})  # TODO: perhaps check for answer?
+            url = 'http://{0}:{1}/notify'.format(successor.ip, successor.port)
+            try:
+                self.transport.post(url, data={'ip': self.ip, 'port': self.port})  # TODO: perhaps check for answer?
+            except:
+                pass
         else:
-            if self.predecessor and in_interval(self.key, self.successor.key, self.predecessor.key):
-                self.successor = self.predecessor
+            with self.ring_lock:
+                if self.predecessor and in_interval(self.key, self.successor.key, self.predecessor.key):
+                    self.successor = self.predecessor
             self.notify(self)
-        self.finger_table.update_finger(0, self.successor)
+        with self.ring_lock:
+            self.finger_table.update_finger(0, self.successor)
+            changed = self.successor.key != old_successor.key
+        if changed:
+            self.lookup_cache.clear()
 
     def update_successor_list(self):
         new_successor_list = []
@@ -212,28 +595,45 @@ class Node:
                 break
             result = self._make_successor_request(succ, None)
             if result is None and succ == self.successor:
-                self.set_new_successor()
+                self.set_new_successor(succ)
                 succ = self.successor
             if result and self.key != result.key:
                 new_successor_list.append(result)
                 succ = result
-        self.successor_list = new_successor_list
+        with self.ring_lock:
+            self.successor_list = new_successor_list
 
-    def set_new_successor(self):
-        if len(self.successor_list) > 0:
-            self.successor = self.successor_list.pop(0)
-            self.finger_table.update_finger(0, self.successor)
-        else:
-            self.leave()
+    def set_new_successor(self, failed: 'Node'):
+        """Replace the failed successor with the first node of the successor list, unless it was replaced already"""
+        with self.ring_lock:
+            if self.successor.key != failed.key:
+                return
+            if len(self.successor_list) > 0:
+                self.successor = self.successor_list.pop(0)
+                self.finger_table.update_finger(0, self.successor)
+            else:
+                self.leave()
 
     def check_predecessor(self):
+        predecessor = self.predecessor
+        if predecessor is None:
+            return
         try:
-            url = 'http://{0}:{1}/successor'.format(self.predecessor.ip, self.predecessor.port)
-            requests.get(url)
+            url = 'http://{0}:{1}/successor'.format(predecessor.ip, predecessor.port)
+            self.transport.get(url)
         except:
-            self.predecessor = None
+            with self.ring_lock:
+                # Only forget the predecessor we checked, notify may have set a new one in the meantime
+                if self.predecessor is not None and self.predecessor.key == predecessor.key:
+                    self.ring_failures += 1
+                    self.lookup_cache.clear()
+                    self.predecessor = None
 
     def fix_fingers(self):
+        if FINGER_REPAIR == 'batch':
+            self.fix_all_fingers()
+            return
+
         # i = random.randint(0, self.finger_table.max_i) # Find random entry to update
         inc_prob = random.randint(0, 10)
 
@@ -243,6 +643,7 @@ class Node:
                         self.finger_table.update_finger(i, node) # Update finger table
                         self.finger_index_update = i+1
         else:
+            self.ring_failures += 1
             # Finger table has a small change of jumping one index even if this
             # did not get updated.
             if inc_prob == 1:
@@ -260,7 +661,7 @@ class Node:
             return True
         try:
             url = 'http://{0}:{1}/add_photon'.format(node.ip, node.port)
-            requests.post(url, data={'photon_id': photon_id})
+            self.transport.post(url, data={'photon_id': photon_id})
             return True
         except:
             return False
@@ -272,20 +673,68 @@ class Node:
 
     def get_photons_from_successor(self):
         url = 'http://{0}:{1}/give_photons'.format(self.successor.ip, self.successor.port)
-        data = json.loads(requests.post(url, data={'key': self.key}).text)
+        data = json.loads(self.transport.post(url, data={'key': self.key}).text)
         print(self.port, "Got the following photons from successor: ", data['photons'])
-        for photon_id in data['photons']:
-            print("Adding: ", photon_id)
-            photon = Photon(photon_id)
-            self.photons.append(photon)
+        photons = [Photon(photon_id) for photon_id in data['photons']]
 
-            try:
-                # Get data from photon master
-                result = self.poll_data_request(self.successor.ip, self.successor.port, photon.key, PhotonBackup(photon_id, None).get_last_poll(self.port))
-                print('Data from successor: {0}'.format(result['msg']))
-                self.poll_data_to_db(result)
-            except Exception as e:
-                print(e)
+        try:
+            # Get the history of all the photons from their old master in one stream
+            self.fetch_handoff(self.successor, [x.key for x in photons])
+        except Exception as e:
+            print(e)
+        # Only collect once the history is stored, such that new measurements are numbered after it
+        self.photons.extend(photons)
+
+    def handoff_stream(self, cursors: dict):
+        """
+        Generate the history of several photons as gzip compressed, newline delimited JSON
+
+        :param cursors: dict mapping photon keys to the sequence number after which the history should start
+        """
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for photon_key, cursor in cursors.items():
+            cursor = int(cursor)
+            while True:
+                rows = self.storage.after(int(photon_key), cursor, REPLICATION_BATCH)
+                if not rows:
+                    break
+                chunk = compressor.compress(''.join(json.dumps(x) + '\n' for x in rows).encode('utf-8'))
+                if chunk:
+                    yield chunk
+                cursor = rows[-1]['seq']
+        yield compressor.flush()
+
+    def fetch_handoff(self, node: 'Node', photon_keys: list):
+        """Stream the history of the photons from node and store it in batched transactions"""
+        if not photon_keys:
+            return
+        start = time.time()
+        url = 'http://{0}:{1}/handoff_data'.format(node.ip, node.port)
+        cursors = {key: self.storage.last_seq(key) for key in photon_keys}
+        response = self.transport.post(url, json={'cursors': cursors}, stream=True, measure=False)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        received = 0
+        stored = 0
+        buffer = b''
+        batch = []
+        for chunk in response.iter_content(chunk_size=65536):
+            received += len(chunk)
+            lines = (buffer + decompressor.decompress(chunk)).split(b'\n')
+            buffer = lines.pop()
+            batch.extend(json.loads(line.decode('utf-8')) for line in lines if line)
+            if len(batch) >= HANDOFF_BATCH:
+                stored += self.storage.insert_replicated([(x['seq'], x['date'], x['id'], x['data']) for x in batch])
+                batch = []
+        buffer += decompressor.flush()
+        batch.extend(json.loads(line.decode('utf-8')) for line in buffer.split(b'\n') if line)
+        stored += self.storage.insert_replicated([(x['seq'], x['date'], x['id'], x['data']) for x in batch])
+
+        duration = max(time.time() - start, 0.001)
+        self.handoff_stats = {'photons': len(photon_keys), 'rows': stored, 'bytes': received,
+                              'duration': round(duration, 3),
+                              'rows_per_second': round(stored / duration, 1),
+                              'bytes_per_second': round(received / duration, 1)}
+        print('[{0}] Handoff from {1}: {2}'.format(self.port, node, self.handoff_stats))
 
     def give_photons(self, key: int):
         result = [x.photon_id for x in self.photons if in_interval(self.key, key, x.key)]
@@ -297,83 +746,396 @@ class Node:
         return result
 
     def collect_data(self):
-        now = datetime.now()
-        con = sql.connect('data/' + str(self.port) + '.db')
+        start = time.time()
+        now = int(start * 1000)
+        # A departure waits until the measurements of a running pass are stored, so they are part of the handoff
+        with self.collect_lock:
+            photons = list(self.photons)
 
-        for photon in self.photons:
-            value = photon.pull_light_value()
-            if value is not "None":
-                con.execute("INSERT INTO measurement (date, id, data) VALUES (?,?,?)", (now, photon.key, int(value)))
-                print('Collected data value from photon:{0}'.format(value))
-        con.commit()
-        con.close()
+            # Sample all photons concurrently, the particle cloud api is slow compared to the rest of the pass
+            with ThreadPoolExecutor(max(min(COLLECT_WORKERS, len(photons)), 1)) as pool:
+                values = list(pool.map(lambda photon: photon.pull_light_value(self.cloud_transport), photons))
+
+            rows = []
+            failures = 0
+            for photon, value in zip(photons, values):
+                # Photons which could not be read are skipped, nothing is stored for them in this pass
+                try:
+                    rows.append((now, photon.key, int(value)))
+                except (TypeError, ValueError):
+                    failures += 1
+
+            inserted = self.storage.insert(rows)
+
+        print('[{0}] Collected {1} values from {2} photons, {3} failed'.format(self.port, len(rows), len(photons),
+                                                                            failures))
+        if REPLICATION_PUSH:
+            self.push_data(photons, inserted)
+
+        self.collect_stats['passes'] += 1
+        self.collect_stats['photons'] = len(photons)
+        self.collect_stats['collected'] = len(rows)
+        self.collect_stats['failures'] = failures
+        self.collect_stats['duration'] = round(time.time() - start, 3)
+
+    def push_data(self, photons: list, rows: list):
+        """
+        Push freshly collected (seq, date, id, data) rows to the backups of the photons. A failed or rejected push
+        is not retried, the backup will pull the rows instead.
+        """
+        by_key = {}
+        for seq, date, photon_key, data in rows:
+            by_key.setdefault(photon_key, []).append({'seq': seq, 'date': date, 'id': photon_key, 'data': data})
+
+        by_backup = {}
+        for photon in photons:
+            if photon.key not in by_key:
+                continue
+            for backup_node in list(photon.backup_nodes.values()):
+                by_backup.setdefault(backup_node.key, (backup_node, []))[1].append(photon)
+
+        for backup_node, backup_photons in by_backup.values():
+            url = 'http://{0}:{1}/push_data'.format(backup_node.ip, backup_node.port)
+            payload = {'ip': self.ip, 'port': self.port, 'photons': {x.key: by_key[x.key] for x in backup_photons}}
+            self.push_stats['pushed'] += 1
+            try:
+                acks = json.loads(self.transport.post(url, json=payload).text)['photons']
+            except Exception as e:
+                print('[{0}] Push to {1} failed: {2}'.format(self.port, backup_node, e))
+                self.push_stats['failed'] += 1
+                continue
+            for photon in backup_photons:
+                if acks.get(str(photon.key)) is not None:
+                    photon.acked_seq[backup_node.key] = max(photon.acked_seq.get(backup_node.key, 0),
+                                                            acks[str(photon.key)])
+                    self.push_stats['acked'] += 1
+
+    def receive_push(self, master_node: 'Node', photons: dict) -> dict:
+        """
+        Store rows pushed by a master. Rows are only accepted for photons we are backup for, and only if they continue
+        directly after our cursor, otherwise the gap is filled by the next poll.
+
+        :return: dict with the new cursor of every photon for which the push was accepted
+        """
+        acks = {}
+        for backup in list(self.photon_backup):
+            rows = photons.get(str(backup.photon_key))
+            if not rows or backup.node.key != master_node.key:
+                continue
+            if backup.cursor is None:
+                backup.cursor = self.storage.last_seq(backup.photon_key)
+            if rows[0]['seq'] > backup.cursor + 1:
+                self.push_stats['rejected'] += 1
+                continue
+            self.storage.insert_replicated([(x['seq'], x['date'], x['id'], x['data']) for x in rows])
+            backup.cursor = max(backup.cursor, rows[-1]['seq'])
+            backup.last_push = time.time()
+            acks[str(backup.photon_key)] = backup.cursor
+            self.push_stats['received'] += 1
+        return acks
 
     def add_backup(self, master_node: 'Node', photon_id: str):
+        # A new master registers itself for a photon we already hold after a takeover
+        for backup in self.photon_backup:
+            if backup.photon_id == photon_id:
+                backup.node = master_node
+                return
         self.photon_backup.append(PhotonBackup(photon_id, master_node))
 
-    def get_latest_data(self, photon_key: int, last_request: str, request_id: int):
+    def replica_nodes(self) -> list:
+        """The first REPLICATION_FACTOR distinct nodes following us, which hold the backups of our photons"""
+        result = []
+        for node in [self.successor] + list(self.successor_list):
+            if node is None or node.key == self.key or node.key in [x.key for x in result]:
+                continue
+            result.append(node)
+        return result[:REPLICATION_FACTOR]
+
+    def photon_holders(self, owner: 'Node'):
+        """
+        Generate the node responsible for a photon followed by the REPLICATION_FACTOR nodes holding its backups.
+        The backups are taken from our successor list if the owner is in it, otherwise they are looked up one by one,
+        and only when the owner did not answer.
+        """
+        yield owner
+        chain = [self, self.successor] + self.successor_list
+        keys = [x.key for x in chain]
+        replicas = chain[keys.index(owner.key) + 1:] if owner.key in keys else []
+        for node in replicas[:REPLICATION_FACTOR]:
+            yield node
+        previous = replicas[-1] if replicas else owner
+        for _ in range(len(replicas), REPLICATION_FACTOR):
+            node, msg, count = self.find_successor((previous.key + 1) % RING_SIZE, self.key)
+            if node is None or node.key == owner.key:
+                return
+            yield node
+            previous = node
+
+    def route_photon_query(self, photon_key: int, params: dict):
+        """
+        Send a query for the data of a photon to the node responsible for it. If that node fails, does not answer
+        within ROUTE_TIMEOUT seconds or does not store the photon (yet), the query is sent to the replicas of the
+        photon instead.
+
+        :param params: the query arguments of /photon/<key>
+        :return: (node which answered, streamed response) or (None, error message)
+        """
+        self.route_stats['queries'] += 1
+        owner, msg, count = self.find_successor(photon_key, self.key)
+        if owner is None:
+            self.route_stats['failed'] += 1
+            return None, "Could not find the node responsible for {0}: {1}".format(photon_key, msg)
+        if owner.key == self.key:
+            self.route_stats['local'] += 1
+        missing = False
+        for i, node in enumerate(self.photon_holders(owner)):
+            url = 'http://{0}:{1}/photon/{2}'.format(node.ip, node.port, photon_key)
+            try:
+                response = self.transport.get(url, params=params, stream=True, measure=False,
+                                              timeout=(self.transport.timeout[0], ROUTE_TIMEOUT))
+            except:
+                if i == 0:
+                    # The cached owner may have left the ring
+                    self.lookup_cache.invalidate(owner.key)
+                self.route_stats['fallbacks'] += 1
+                continue
+            if response.status_code == 404:
+                # E.g. a new owner which is still pulling the history of the photon
+                response.close()
+                missing = True
+                self.route_stats['fallbacks'] += 1
+                continue
+            return node, response
+        self.route_stats['failed'] += 1
+        if missing:
+            return None, "No data for this photon key"
+        return None, "The node responsible for {0} and its replicas did not answer".format(photon_key)
+
+    def broadcast_children(self, limit: int) -> list:
+        """
+        Split the part of the ring from us up to limit between our distinct fingers. Every finger before limit gets
+        the part from itself up to the next finger, such that each node in the part is reached exactly once.
+
+        :return: list of (node, limit of the node)
+        """
+        span = distance(self.key, limit) or RING_SIZE
+        nodes = {}
+        for node in self.finger_table.fingers + [self.successor]:
+            if node is not None and 0 < distance(self.key, node.key) < span:
+                nodes[node.key] = node
+        ordered = sorted(nodes.values(), key=lambda node: distance(self.key, node.key))
+        return [(node, ordered[i + 1].key if i + 1 < len(ordered) else limit) for i, node in enumerate(ordered)]
+
+    def aggregate(self, date_from: int, date_to: int, limit: int, budget: float) -> dict:
+        """
+        Aggregate the measurements of the photons of every node from us up to limit. The part of the ring is split
+        between our fingers, which aggregate their parts in parallel, and their partial aggregates are merged with
+        ours. Parts which do not answer within the budget are left out and reported as missing.
+
+        :param date_from: only measurements dated at or after date_from (epoch ms), None for all
+        :param date_to: only measurements dated before date_to (epoch ms), None for all
+        :param limit: the key of the first node not included, our own key for the whole ring
+        :param budget: seconds left to answer
+        :return: {summary: [count, sum, min, max] or None, photons: int, nodes: int, missing: [nodes which did not answer]}
+        """
+        deadline = time.time() + budget
+        children = self.broadcast_children(limit)
+        pool = ThreadPoolExecutor(max_workers=max(len(children), 1))
+        futures = {}
+        missing = []
+        for child, child_limit in children:
+            child_budget = deadline - time.time() - AGGREGATE_MARGIN
+            if child_budget <= 0:
+                missing.append(str(child))
+                continue
+            url = 'http://{0}:{1}/aggregate/broadcast'.format(child.ip, child.port)
+            payload = {'from': date_from, 'to': date_to, 'limit': child_limit, 'budget': child_budget}
+            futures[pool.submit(self.transport.post, url, json=payload, measure=False,
+                                timeout=(self.transport.timeout[0], child_budget))] = child
+
+        # Our own photons are aggregated while the children work on theirs
+        summaries = [self.storage.summarise(photon.key, date_from, date_to) for photon in list(self.photons)]
+        photons = len(self.photons)
+        nodes = 1
+
+        done, not_done = wait(futures, timeout=max(deadline - time.time(), 0))
+        pool.shutdown(wait=False)
+        for future in not_done:
+            missing.append(str(futures[future]))
+        for future in done:
+            try:
+                partial = json.loads(future.result().text)
+                summaries.append(partial['summary'])
+                photons += partial['photons']
+                nodes += partial['nodes']
+                missing.extend(partial['missing'])
+            except:
+                missing.append(str(futures[future]))
+
+        summary = None
+        for values in summaries:
+            if values is None:
+                continue
+            if summary is None:
+                summary = list(values)
+            else:
+                merge(summary, values)
+        return {'summary': summary, 'photons': photons, 'nodes': nodes, 'missing': missing}
+
+    def is_responsible(self, key: int) -> bool:
+        return self.predecessor is not None and in_interval(self.predecessor.key, self.key, key)
+
+    def get_latest_data(self, photon_key: int, cursor: int, request_id: int, limit: int = REPLICATION_BATCH):
+        """
+        Return the measurements of a photon after the cursor, at most limit rows
+
+        :return: (is_backup, rows, new cursor, whether more rows are available)
+        """
         is_backup = False
-        con = sql.connect('data/' + str(self.port) + '.db')
-        con.row_factory = sql.Row  # This enables column access by name: row['column_name']
-        db = con.cursor()
-        rows = db.execute("SELECT * FROM measurement WHERE id = ? AND date > ?", [photon_key, last_request]).fetchall()
-        con.commit()
-        con.close()
-        result = json.dumps([dict(x) for x in rows])
-
-        if request_id == self.successor.key:
+        rows = self.storage.after(photon_key, cursor, limit + 1)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            cursor = rows[-1]['seq']
+
+        if request_id in [x.key for x in self.replica_nodes()]:
             for photon in self.photons:
                 if photon_key == photon.key:
                     is_backup = True
 
-        return is_backup, result
+        return is_backup, rows, cursor, more
 
-    def poll_data_request(self, ip, port, photon_key, last_request):
+    def poll_data_request(self, ip, port, photon_key, cursor):
         url = 'http://{0}:{1}/get_latest_data'.format(ip, port)
-        params = {'photon_key': photon_key, 'last_request': last_request,
+        params = {'photon_key': photon_key, 'cursor': cursor, 'limit': REPLICATION_BATCH,
                   'request_id': self.key}
-        return json.loads(requests.get(url, params=params).text)
-
-    def poll_data_to_db(self, data):
-        con = sql.connect('data/' + str(self.port) + '.db')
-        for data_row in json.loads(data['msg']):
-            print(data_row)
-            print(data_row['date'])
-            print(data_row['id'])
-            print(data_row['data'])
-            con.execute("INSERT INTO measurement (date, id, data) VALUES (?,?,?)",
-                        (data_row['date'], data_row['id'], data_row['data']))
-        con.commit()
-        con.close()
+        return json.loads(self.transport.get(url, params=params).text)
+
+    def poll_data_to_db(self, data) -> int:
+        """Store the rows of a replication response and return the new cursor"""
+        rows = [(data_row['seq'], data_row['date'], data_row['id'], data_row['data']) for data_row in data['msg']]
+        self.storage.insert_replicated(rows)
+        return data['cursor']
+
+    def get_latest_data_batch(self, cursors: dict, request_id: int, limit: int = REPLICATION_BATCH) -> dict:
+        """Run get_latest_data for several photons, cursors maps photon keys to cursors"""
+        result = {}
+        for photon_key, cursor in cursors.items():
+            is_backup, rows, cursor, more = self.get_latest_data(int(photon_key), int(cursor), request_id, limit)
+            result[str(photon_key)] = {'is_backup': is_backup, 'msg': rows, 'cursor': cursor, 'more': more}
+        return result
+
+    def poll_data_batch_request(self, ip, port, cursors: dict):
+        url = 'http://{0}:{1}/get_latest_data_batch'.format(ip, port)
+        payload = {'cursors': cursors, 'limit': REPLICATION_BATCH, 'request_id': self.key}
+        return json.loads(self.transport.post(url, json=payload).text)
 
     def poll_data(self):
-        # run through backup list
-            # Get new data
-            # Backoff or become master if needed
+        # Group the backups by master, such that all photons of a master are polled in one request
+        masters = {}
         for backup in list(self.photon_backup):
-            try:
-                data = self.poll_data_request(backup.node.ip, backup.node.port, backup.photon_key, backup.get_last_poll(self.port))
+            masters.setdefault((backup.node.ip, str(backup.node.port)), []).append(backup)
 
-                if data['is_backup'] is False:
-                    self.photon_backup.remove(backup)
-                    continue
+        # Masters which pushed all their photons recently are alive and up to date, no need to poll them
+        if REPLICATION_PUSH:
+            now = time.time()
+            masters = {master: backups for master, backups in masters.items()
+                       if any(now - x.last_push > PUSH_GRACE for x in backups)}
 
-                self.poll_data_to_db(data)
+        for (ip, port), backups in masters.items():
+            try:
+                pending = backups
+                while pending:
+                    for backup in pending:
+                        if backup.cursor is None:
+                            backup.cursor = self.storage.last_seq(backup.photon_key)
+                    data = self.poll_data_batch_request(ip, port, {x.photon_key: x.cursor for x in pending})
+                    more = []
+                    for backup in pending:
+                        result = data['photons'][str(backup.photon_key)]
+                        if result['is_backup'] is False:
+                            self.photon_backup.remove(backup)
+                            continue
+                        backup.cursor = max(backup.cursor, self.poll_data_to_db(result))
+                        if result['more']:
+                            more.append(backup)
+                    pending = more
 
             except Exception as e:
                 print(e)
-                # TODO: make master
-                print('[{0}] TAKING OVER PHOTON KEY: {1}. IM THE MASTER NOW.'.format(self.port, backup.photon_key))
-                self.add_photon(backup.photon_id)
-                self.photon_backup.remove(backup)
+                for backup in backups:
+                    if backup not in self.photon_backup:
+                        continue
+                    # Of all the replicas only the one now responsible for the key takes over. The others keep
+                    # their copy and are registered by the new master in its check_backups.
+                    if not self.is_responsible(backup.photon_key):
+                        continue
+                    print('[{0}] TAKING OVER PHOTON KEY: {1}. IM THE MASTER NOW.'.format(self.port, backup.photon_key))
+                    self.reconcile_photon(backup.photon_key)
+                    self.add_photon(backup.photon_id)
+                    self.photon_backup.remove(backup)
 
-    def get_photon_data(self, photon_key: int):
-        for photon in self.photons:
-            if photon.key == photon_key:
-                values = photon.get_latest_light_values(self.port, "0")
-                print(values)
-                return values
-        return None
+    def reconcile_photon(self, photon_key: int):
+        """
+        Pull the measurements of a photon we take over from its other replicas, which may have received pushes from
+        the old master that we missed. New measurements are numbered after the newest of them, so a sequence number
+        that a replica already holds is never used again for another measurement.
+        """
+        for node in self.replica_nodes():
+            cursor = self.storage.last_seq(photon_key)
+            try:
+                while True:
+                    data = self.poll_data_batch_request(node.ip, node.port, {photon_key: cursor})
+                    result = data['photons'][str(photon_key)]
+                    cursor = max(cursor, self.poll_data_to_db(result))
+                    if not result['more']:
+                        break
+            except Exception as e:
+                print('[{0}] Could not reconcile photon {1} with {2}: {3}'.format(self.port, photon_key, node, e))
+
+    def stores_photon(self, photon_key: int) -> bool:
+        """Return whether the photon is stored at this node, as master or as one of its replicas"""
+        return any(x.key == photon_key for x in self.photons) or \
+            any(x.photon_key == photon_key for x in self.photon_backup)
+
+    def get_photon_points(self, photon_key: int, date_from: int = None, date_to: int = None,
+                          max_points: int = GRAPH_POINTS):
+        """
+        Summarise the measurements of a photon stored at this node with at most max_points points, see downsample
+
+        :return: (bucket width in ms, 0 for raw measurements, list of points) or None if the photon is not stored here
+        """
+        if not self.stores_photon(photon_key):
+            return None
+        return downsample(self.storage, photon_key, date_from, date_to, max_points)
+
+    def get_photon_data(self, photon_key: int, cursor: int = 0, date_from: int = None, date_to: int = None,
+                        limit: int = None):
+        """
+        Read the measurements of a photon stored at this node, as master or as one of its replicas
+
+        :param cursor: only measurements with a sequence number larger than cursor
+        :param date_from: only measurements dated at or after date_from (epoch ms)
+        :param date_to: only measurements dated before date_to (epoch ms)
+        :param limit: maximum number of measurements, None for all
+        :return: generator of measurements ordered by seq, read from the storage in batches, or None if the photon
+        is not stored here
+        """
+        if not self.stores_photon(photon_key):
+            return None
+
+        def rows(cursor, remaining):
+            while remaining is None or remaining > 0:
+                batch = REPLICATION_BATCH if remaining is None else min(remaining, REPLICATION_BATCH)
+                page = self.storage.after(photon_key, cursor, batch, date_from, date_to)
+                yield from page
+                if len(page) < batch:
+                    return
+                cursor = page[-1]['seq']
+                if remaining is not None:
+                    remaining -= len(page)
+
+        return rows(cursor, limit)
 
     def check_backups(self):
         # Loop though all photon_backups
@@ -381,16 +1143,43 @@ class Node:
         # Add new backups if needed
         if self.key == self.successor.key:
             return
+        replicas = self.replica_nodes()
+        replica_keys = [x.key for x in replicas]
         for photon in self.photons:
-            if photon.backup_node_key == self.successor.key:
-                continue
-            # Add backup
-            try:
-                url = 'http://{0}:{1}/add_backup'.format(self.successor.ip, self.successor.port)
-                requests.post(url, data={'ip': self.ip, 'port': self.port, 'photon_id': photon.photon_id})
-                photon.backup_node_key = self.successor.key
-            except:
-                photon.backup_node_key = None
+            # Forget backups which are no longer among our first successors
+            for key in list(photon.backup_nodes):
+                if key not in replica_keys:
+                    del photon.backup_nodes[key]
+                    photon.acked_seq.pop(key, None)
+            for replica in replicas:
+                if replica.key in photon.backup_nodes:
+                    continue
+                # Add backup
+                try:
+                    url = 'http://{0}:{1}/add_backup'.format(replica.ip, replica.port)
+                    self.transport.post(url, data={'ip': self.ip, 'port': self.port, 'photon_id': photon.photon_id})
+                    photon.backup_nodes[replica.key] = replica
+                except:
+                    pass
+
+    def ring_state(self) -> tuple:
+        """Snapshot of the routing state, used to detect whether maintenance changed anything"""
+        return (self.successor.key if self.successor else None,
+                self.predecessor.key if self.predecessor else None,
+                tuple(f.key if f else None for f in self.finger_table.fingers),
+                tuple(s.key for s in self.successor_list),
+                self.ring_failures)
+
+    def get_stats(self) -> dict:
+        return {'transport': self.transport.stats(),
+                'collect_data': self.collect_stats,
+                'push': self.push_stats,
+                'handoff': self.handoff_stats,
+                'fingers': self.finger_stats,
+                'lookups': self.lookup_stats,
+                'routed_queries': self.route_stats,
+                'lookup_cache': self.lookup_cache.stats(),
+                'lookup_requests': self.seen_requests.stats()}
 
     def __str__(self):
         return "(" + self.ip + ":" + str(self.port) + ", " + str(self.key) + ")"
@@ -1,6 +1,5 @@
 import requests
 import json
-import sqlite3 as sql
 
 from chord.util import encode_key
 
@@ -10,37 +9,31 @@ class Photon:
     def __init__(self, photon_id: str):
         self.photon_id = photon_id
         self.key = encode_key(photon_id)
-        self.backup_node_key = None
+        # The nodes this photon is replicated to, by key
+        self.backup_nodes = {}
+        # Sequence number of the last measurement each backup acknowledged a push for, by key
+        self.acked_seq = {}
 
 
-    def get_light_value(self, port: int) -> str:
-        con = sql.connect('data/' + str(port) + '.db')
-        cur = con.execute("SELECT * FROM measurement WHERE id = ?  ORDER BY date DESC", [self.key])
-        rv = cur.fetchone()
-        print(rv)
+    def get_light_value(self, storage) -> str:
+        rv = storage.latest(self.key)
         try:
-            return rv[2]
+            return rv['data']
         except:
             return "None"
-        finally:
-            con.close()
 
-    def get_latest_light_values(self, port: int, last_request: str):
-        con = sql.connect('data/' + str(port) + '.db')
-        con.row_factory = sql.Row  # This enables column access by name: row['column_name']
-        db = con.cursor()
-        rows = db.execute("SELECT * FROM measurement WHERE id = ? AND date > ?", [self.key, last_request]).fetchall()
-        con.commit()
-        con.close()
-        return json.dumps([dict(x) for x in rows])
+    def pull_light_value(self, transport=None) -> str:
+        """
+        Read the current light value from the particle cloud, optionally reusing the connections of a transport
 
-    def pull_light_value(self) -> str:
+        :return: the value, or None if the photon could not be read
+        """
         try:
             url = "https://api.particle.io/v1/devices/{0}/analogvalue?access_token=8239b3935d2f4c43fef1ba2a03c1112a2ea1f1ec".format(self.photon_id)
-            data = json.loads(requests.get(url, timeout=1).text)
+            data = json.loads((transport or requests).get(url, timeout=1).text)
             return str(data['result'])
         except:
-            return "42" #"None"
+            return None
 
     def __str__(self):
         return "(id: " + self.photon_id + ", key:" + str(self.key) + ")"
@@ -55,16 +48,8 @@ class PhotonBackup:
         self.photon_id = photon_id
         self.photon_key = encode_key(photon_id)
         self.node = node
-
-    def get_last_poll(self, port):
-        con = sql.connect('data/' + str(port) + '.db')
-        cur = con.execute("SELECT * FROM measurement WHERE id = ?  ORDER BY date DESC", [self.photon_key])
-        rv = cur.fetchone()
-        print(rv)
-        try:
-            return rv[0]
-        except:
-            return "0"
-        finally:
-            con.close()
+        # Sequence number of the last measurement replicated from the master, None until the first poll
+        self.cursor = None
+        # Time of the last push received from the master
+        self.last_push = 0
 
@@ -0,0 +1,116 @@
+from bisect import bisect_left, insort
+
+from config import ROLLUP_RESOLUTIONS
+
+
+def bucket_start(date: int, resolution: int) -> int:
+    return date - date % resolution
+
+
+def aggregate(rows) -> dict:
+    """
+    Aggregate measurements into rollup buckets of every resolution
+
+    :param rows: iterable of (id, date, data)
+    :return: dict mapping (id, resolution, bucket start) to [count, sum, min, max]
+    """
+    result = {}
+    for photon_key, date, data in rows:
+        for resolution in ROLLUP_RESOLUTIONS:
+            key = (photon_key, resolution, bucket_start(date, resolution))
+            if key in result:
+                merge(result[key], [1, data, data, data])
+            else:
+                result[key] = [1, data, data, data]
+    return result
+
+
+def merge(values: list, other: list):
+    """Merge the [count, sum, min, max] of other into values"""
+    values[0] += other[0]
+    values[1] += other[1]
+    values[2] = min(values[2], other[2])
+    values[3] = max(values[3], other[3])
+
+
+def point(date: int, values: list) -> dict:
+    count, total, low, high = values
+    return {'date': date, 'count': count, 'min': low, 'max': high, 'mean': total / count}
+
+
+class Rollups:
+    """
+    In-memory rollups of the measurements of photons, per resolution. The bucket starts of each photon and
+    resolution are kept sorted, so a time range is found with a binary search.
+    """
+
+    def __init__(self):
+        self.buckets = {}  # (id, resolution) -> {bucket start: [count, sum, min, max]}
+        self.starts = {}  # (id, resolution) -> sorted bucket starts
+
+    def add(self, aggregated: dict):
+        for (photon_key, resolution, start), values in aggregated.items():
+            buckets = self.buckets.setdefault((photon_key, resolution), {})
+            if start in buckets:
+                merge(buckets[start], values)
+                continue
+            buckets[start] = list(values)
+            starts = self.starts.setdefault((photon_key, resolution), [])
+            if not starts or starts[-1] < start:
+                starts.append(start)
+            else:
+                insort(starts, start)
+
+    def query(self, photon_key: int, resolution: int, date_from: int = None, date_to: int = None) -> list:
+        buckets = self.buckets.get((photon_key, resolution), {})
+        starts = self.starts.get((photon_key, resolution), [])
+        first = bisect_left(starts, bucket_start(date_from, resolution)) if date_from is not None else 0
+        last = bisect_left(starts, date_to) if date_to is not None else len(starts)
+        return [point(start, buckets[start]) for start in starts[first:last]]
+
+    def clear(self):
+        self.buckets = {}
+        self.starts = {}
+
+
+def downsample(storage, photon_key: int, date_from: int, date_to: int, max_points: int) -> (int, list):
+    """
+    Summarise the measurements of a photon in a time range with at most max_points points.
+
+    The range is split into buckets of equal width starting at its beginning, which are read from the finest rollup
+    that is not wider than a bucket and merged. Rollup buckets sticking out of the range are summarised from the
+    measurements inside it instead. If there are few enough measurements, they are returned as they are.
+
+    :return: (bucket width in ms, 0 for raw measurements, list of {date, count, min, max, mean})
+    """
+    summary = storage.summarise(photon_key, date_from, date_to)
+    if summary is None:
+        return 0, []
+    if summary[0] <= max_points:
+        rows = storage.after(photon_key, 0, max_points, date_from, date_to)
+        return 0, [point(row['date'], [1, row['data'], row['data'], row['data']]) for row in rows]
+
+    # Open ends of the range are narrowed to the oldest and the newest measurement
+    start = date_from if date_from is not None else storage.after(photon_key, 0, 1)[0]['date']
+    stop = date_to if date_to is not None else storage.latest(photon_key)['date'] + 1
+    width = -(-(stop - start) // max(max_points - 1, 1))
+    resolution = max([x for x in ROLLUP_RESOLUTIONS if x <= width] or [min(ROLLUP_RESOLUTIONS)])
+    width = -(-width // resolution) * resolution
+
+    merged = {}
+    for row in storage.rollup(photon_key, resolution, start, stop):
+        date = row['date']
+        if date < start or date + resolution > stop:
+            # Only the first and the last bucket can stick out of the range
+            date = max(date, start)
+            values = storage.summarise(photon_key, date, min(row['date'] + resolution, stop))
+            if values is None:
+                continue
+        else:
+            values = [row['count'], row['mean'] * row['count'], row['min'], row['max']]
+        group = start + (date - start) // width * width
+        if group in merged:
+            merge(merged[group], values)
+        else:
+            merged[group] = values
+    return width, [point(group, merged[group]) for group in sorted(merged)]
@@ -0,0 +1,189 @@
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import aiohttp
+from aiohttp import web
+
+from chord.node import Node
+from chord.util import in_interval
+from config import (
+    LOOKUP_MAX_HOPS,
+    RPC_CONNECT_TIMEOUT,
+    RPC_READ_TIMEOUT,
+    RPC_POOL_SIZE,
+    RPC_WORKERS
+)
+
+# Headers which only concern a single connection, they are not copied from the WSGI response
+HOP_BY_HOP = ('connection', 'keep-alive', 'transfer-encoding')
+
+
+class AsyncServer:
+    """
+    Event-driven server for a node, used when SERVER_MODE is 'async'.
+
+    The ring RPCs are answered on the event loop. Lookups which have to be forwarded wait for the next node with
+    non-blocking requests, so a node under lookup load does not hold a thread per waiting lookup. Every other route,
+    e.g. the html views and the replication endpoints, is passed on to the Flask app, which runs on a pool of
+    RPC_WORKERS threads.
+    """
+
+    def __init__(self, node: Node, wsgi_app, on_notify=None):
+        self.node = node
+        self.wsgi_app = wsgi_app
+        self.on_notify = on_notify
+        self.pool = ThreadPoolExecutor(max_workers=RPC_WORKERS)
+        self.session = None
+        self.app = web.Application()
+        self.app.router.add_get('/successor', self.successor)
+        self.app.router.add_get('/predecessor', self.predecessor)
+        self.app.router.add_get('/successor/{key:\\d+}/{start_key:\\d+}/', self.find_successor)
+        self.app.router.add_get('/successor/{key:\\d+}/{start_key:\\d+}/{count:\\d+}', self.find_successor)
+        self.app.router.add_get('/closest_finger/{key:\\d+}', self.closest_finger)
+        self.app.router.add_post('/notify', self.notify)
+        self.app.router.add_route('*', '/{path:.*}', self.wsgi)
+        self.app.on_startup.append(self._start)
+        self.app.on_cleanup.append(self._stop)
+
+    async def _start(self, app):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=RPC_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(sock_connect=RPC_CONNECT_TIMEOUT, sock_read=RPC_READ_TIMEOUT))
+
+    async def _stop(self, app):
+        await self.session.close()
+        self.pool.shutdown(wait=False)
+
+    def run(self, host: str, port: int):
+        # The signal handlers of the node stay in place, they leave the network gracefully
+        web.run_app(self.app, host=host, port=port, handle_signals=False, print=None)
+
+    async def successor(self, request):
+        successor_node = self.node.successor
+        if successor_node:
+            return web.json_response({'successor': True, 'key': successor_node.key, 'ip': successor_node.ip,
+                                      'port': successor_node.port})
+        return web.json_response({'successor': False})
+
+    async def predecessor(self, request):
+        predecessor_node = self.node.predecessor
+        if predecessor_node:
+            return web.json_response({'predecessor': True, 'key': predecessor_node.key, 'ip': predecessor_node.ip,
+                                      'port': predecessor_node.port})
+        return web.json_response({'predecessor': False})
+
+    async def closest_finger(self, request):
+        key = int(request.match_info['key'])
+        pf = self.node.closest_preceding_finger(key)
+        successor_node = self.node.successor
+        return web.json_response({'node_ip': pf.ip,
+                                  'node_port': pf.port,
+                                  'node_key': pf.key,
+                                  'successor_ip': successor_node.ip,
+                                  'successor_port': successor_node.port,
+                                  'successor_key': successor_node.key,
+                                  'done': in_interval(self.node.key, successor_node.key, key)})
+
+    async def notify(self, request):
+        form = await request.post()
+        if self.node.notify(Node(form.get('ip'), form.get('port'))) and self.on_notify is not None:
+            # A new predecessor has joined, leave slow maintenance mode
+            self.on_notify()
+        return web.json_response({'success': True})
+
+    async def _forward(self, url: str, timeout: float = None):
+        """Forward a lookup, return (answer, None) or (None, reason of the failure)"""
+        try:
+            print("[{1}][Async] Successor request: {0}".format(url, self.node.port))
+            kwargs = {'timeout': aiohttp.ClientTimeout(total=timeout)} if timeout is not None else {}
+            async with self.session.get(url, **kwargs) as response:
+                data = await response.json(content_type=None)
+        except asyncio.TimeoutError:
+            return None, 'timeout'
+        except aiohttp.ClientError:
+            return None, 'unreachable'
+        except ValueError:
+            return None, 'bad_response'
+        if not isinstance(data, dict):
+            return None, 'bad_response'
+        return data, None
+
+    async def find_successor(self, request):
+        """The same lookup as Node.find_successor for lookups forwarded by other nodes, without blocking a thread"""
+        key = int(request.match_info['key'])
+        start_key = int(request.match_info['start_key'])
+        count = int(request.match_info.get('count', 0))
+        if self.node.key == start_key:
+            return web.json_response({'successor': False, 'error': 'node.key == start key == {0}'.format(start_key)})
+
+        steps = self.node.lookup(key, start_key, count, request_id=request.query.get('rid'),
+                                 ttl=int(request.query.get('ttl', LOOKUP_MAX_HOPS)))
+        try:
+            node, url, timeout = next(steps)
+            while True:
+                node, url, timeout = steps.send(await self._forward(url, timeout))
+        except StopIteration as e:
+            result, msg, count = e.value
+        if result is None:
+            return web.json_response({'successor': False, 'error': msg})
+        return web.json_response({'successor': True, 'key': result.key, 'ip': result.ip, 'port': result.port,
+                                  'msg': msg, 'count': count})
+
+    def _environ(self, request, body: bytes) -> dict:
+        environ = {'REQUEST_METHOD': request.method,
+                   'SCRIPT_NAME': '',
+                   'PATH_INFO': request.path,
+                   'QUERY_STRING': request.query_string,
+                   'SERVER_NAME': self.node.ip,
+                   'SERVER_PORT': str(self.node.port),
+                   'SERVER_PROTOCOL': 'HTTP/{0}.{1}'.format(*request.version),
+                   'REMOTE_ADDR': request.remote or '',
+                   'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+                   'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.version': (1, 0),
+                   'wsgi.url_scheme': 'http',
+                   'wsgi.input': BytesIO(body),
+                   'wsgi.errors': sys.stderr,
+                   'wsgi.multithread': True,
+                   'wsgi.multiprocess': False,
+                   'wsgi.run_once': False}
+        for name, value in request.headers.items():
+            name = name.upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ['HTTP_' + name] = value
+        return environ
+
+    async def wsgi(self, request):
+        """Serve a request with the Flask app on the thread pool, streaming its response"""
+        loop = asyncio.get_event_loop()
+        body = await request.read()
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(k, v) for k, v in headers if k.lower() not in HOP_BY_HOP]
+
+        result = await loop.run_in_executor(self.pool, self.wsgi_app, self._environ(request, body), start_response)
+        chunks = iter(result)
+        try:
+            # The status is only known once the first chunk is produced by streaming responses
+            first = await loop.run_in_executor(self.pool, next, chunks, None)
+            response = web.StreamResponse(status=started['status'])
+            for name, value in started['headers']:
+                if name.lower() == 'content-length':
+                    response.content_length = int(value)
+                else:
+                    response.headers.add(name, value)
+            await response.prepare(request)
+            chunk = first
+            while chunk is not None:
+                if chunk:
+                    await response.write(chunk)
+                chunk = await loop.run_in_executor(self.pool, next, chunks, None)
+            await response.write_eof()
+            return response
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(self.pool, result.close)
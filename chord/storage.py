@@ -0,0 +1,217 @@
+import sqlite3 as sql
+import threading
+
+from chord.rollup import aggregate, point
+from chord.timeseries import parse_date
+from config import INTERVAL, STORAGE_BACKEND, ROLLUP_RESOLUTIONS
+
+
+def open_storage(port: int):
+    """Open the measurement storage of the node running on port, using the configured STORAGE_BACKEND"""
+    if STORAGE_BACKEND == 'segments':
+        from chord.timeseries import SegmentStorage
+        return SegmentStorage.for_port(port)
+    return Storage.for_port(port)
+
+
+class Storage:
+    """
+    Measurement storage of a node.
+
+    The node keeps one long-lived connection to its sqlite database, shared by all threads and guarded by a lock.
+    The database runs in WAL mode and the measurement table is indexed on (id, date), so the per photon queries
+    stay cheap as the table grows. sqlite caches the prepared statements of the connection. Dates are integer epoch
+    milliseconds and keys are integers, which sqlite stores in 64 bits. Full sha-256 keys (INTERVAL = None) need the
+    segments backend.
+
+    Every measurement gets a sequence number which increases monotonically per photon. It is assigned by the master
+    of the photon and kept by its backups, so replication can resume from the last sequence number received.
+
+    The rollup table holds the count, sum, min and max of the measurements per photon and ROLLUP_RESOLUTIONS bucket.
+    It is updated in the same transaction as the measurements are inserted.
+    """
+
+    def __init__(self, path: str):
+        if INTERVAL is None:
+            raise ValueError('Full sha-256 keys (INTERVAL = None) do not fit in sqlite, use STORAGE_BACKEND = '
+                             '\'segments\'')
+        self.path = path
+        self.lock = threading.Lock()
+        self.con = sql.connect(path, check_same_thread=False, cached_statements=128)
+        self.con.row_factory = sql.Row  # This enables column access by name: row['column_name']
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.sequences = {}
+        self._create()
+
+    @classmethod
+    def for_port(cls, port: int) -> 'Storage':
+        return cls('data/' + str(port) + '.db')
+
+    def _create(self):
+        with self.con:
+            columns = [x[1] for x in self.con.execute('PRAGMA table_info(measurement)')]
+            # Databases of older versions have no sequence numbers, and may store dates as text
+            upgrade = bool(columns) and 'seq' not in columns
+            if upgrade:
+                # The index would move along with the renamed table and be dropped with it
+                self.con.execute('DROP INDEX IF EXISTS measurement_id_date')
+                self.con.execute('ALTER TABLE measurement RENAME TO measurement_old')
+            self.con.execute('CREATE TABLE IF NOT EXISTS measurement '
+                             '(seq INTEGER, date INTEGER, id INTEGER, data INTEGER)')
+            self.con.execute('CREATE INDEX IF NOT EXISTS measurement_id_date ON measurement (id, date)')
+            self.con.execute('CREATE UNIQUE INDEX IF NOT EXISTS measurement_id_seq ON measurement (id, seq)')
+            if upgrade:
+                self._upgrade()
+            exists = self.con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'rollup'").fetchone()
+            self.con.execute('CREATE TABLE IF NOT EXISTS rollup (id INTEGER, resolution INTEGER, bucket INTEGER, '
+                             'count INTEGER, sum INTEGER, min INTEGER, max INTEGER, '
+                             'PRIMARY KEY (id, resolution, bucket))')
+            if not exists:
+                # Databases of older versions have measurements without rollups
+                for resolution in ROLLUP_RESOLUTIONS:
+                    self.con.execute('INSERT INTO rollup SELECT id, ?, date - date % ?, COUNT(*), SUM(data), '
+                                     'MIN(data), MAX(data) FROM measurement GROUP BY id, date - date % ?',
+                                     [resolution, resolution, resolution])
+
+    def _upgrade(self, batch_size: int = 10000):
+        """Copy the measurements of an old schema table into the measurement table, numbering them per photon"""
+        sequences = {}
+        cur = self.con.execute('SELECT date, id, data FROM measurement_old ORDER BY id, date')
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            new_rows = []
+            for date, photon_key, data in rows:
+                photon_key = int(photon_key)
+                sequences[photon_key] = sequences.get(photon_key, 0) + 1
+                new_rows.append((sequences[photon_key], parse_date(date), photon_key, data))
+            self.con.executemany("INSERT INTO measurement (seq, date, id, data) VALUES (?,?,?,?)", new_rows)
+        self.con.execute('DROP TABLE measurement_old')
+
+    def _roll_up(self, rows: list):
+        """Add (seq, date, id, data) rows to the rollups, within the transaction inserting them"""
+        aggregated = aggregate((photon_key, date, data) for seq, date, photon_key, data in rows)
+        self.con.executemany("INSERT OR IGNORE INTO rollup VALUES (?,?,?,0,0,?,?)",
+                             [key + (low, high) for key, (count, total, low, high) in aggregated.items()])
+        self.con.executemany("UPDATE rollup SET count = count + ?, sum = sum + ?, min = MIN(min, ?), "
+                             "max = MAX(max, ?) WHERE id = ? AND resolution = ? AND bucket = ?",
+                             [tuple(values) + key for key, values in aggregated.items()])
+
+    def clear(self):
+        with self.lock:
+            with self.con:
+                self.con.execute('DROP TABLE IF EXISTS measurement')
+                self.con.execute('DROP TABLE IF EXISTS rollup')
+            self.sequences = {}
+            self._create()
+
+    def _last_seq(self, photon_key: int) -> int:
+        if photon_key not in self.sequences:
+            rv = self.con.execute("SELECT MAX(seq) FROM measurement WHERE id = ?", [photon_key]).fetchone()
+            self.sequences[photon_key] = rv[0] or 0
+        return self.sequences[photon_key]
+
+    def last_seq(self, photon_key: int) -> int:
+        """Return the sequence number of the newest measurement of a photon, 0 if there is none"""
+        with self.lock:
+            return self._last_seq(photon_key)
+
+    def insert(self, rows: list) -> list:
+        """
+        Insert a batch of newly collected (date, id, data) rows in one transaction
+
+        :return: the inserted rows as (seq, date, id, data)
+        """
+        with self.lock:
+            result = []
+            for date, photon_key, data in rows:
+                seq = self._last_seq(photon_key) + 1
+                self.sequences[photon_key] = seq
+                result.append((seq, date, photon_key, data))
+            with self.con:
+                self.con.executemany("INSERT INTO measurement (seq, date, id, data) VALUES (?,?,?,?)", result)
+                self._roll_up(result)
+        return result
+
+    def insert_replicated(self, rows: list) -> int:
+        """
+        Insert (seq, date, id, data) rows received from the master of the photons, keeping their sequence numbers.
+        Rows which are already stored are skipped.
+
+        :return: the number of inserted rows
+        """
+        with self.lock:
+            new_rows = []
+            for seq, date, photon_key, data in rows:
+                if seq > self._last_seq(photon_key):
+                    self.sequences[photon_key] = seq
+                    new_rows.append((seq, date, photon_key, data))
+            with self.con:
+                self.con.executemany("INSERT INTO measurement (seq, date, id, data) VALUES (?,?,?,?)", new_rows)
+                self._roll_up(new_rows)
+        return len(new_rows)
+
+    def after(self, photon_key: int, cursor: int, limit: int, date_from: int = None, date_to: int = None) -> list:
+        """
+        Return up to limit rows of a photon with a sequence number larger than cursor, ordered by seq. Optionally
+        only rows dated at or after date_from and before date_to are returned.
+        """
+        query = "SELECT * FROM measurement WHERE id = ? AND seq > ?"
+        args = [photon_key, cursor]
+        if date_from is not None:
+            query += " AND date >= ?"
+            args.append(date_from)
+        if date_to is not None:
+            query += " AND date < ?"
+            args.append(date_to)
+        with self.lock:
+            rows = self.con.execute(query + " ORDER BY seq LIMIT ?", args + [limit]).fetchall()
+        return [dict(x) for x in rows]
+
+    def summarise(self, photon_key: int, date_from: int = None, date_to: int = None) -> list:
+        """
+        Return the [count, sum, min, max] of the values of a photon dated at or after date_from and before date_to,
+        or None if there are none
+        """
+        query = "SELECT COUNT(*), SUM(data), MIN(data), MAX(data) FROM measurement WHERE id = ?"
+        args = [photon_key]
+        if date_from is not None:
+            query += " AND date >= ?"
+            args.append(date_from)
+        if date_to is not None:
+            query += " AND date < ?"
+            args.append(date_to)
+        with self.lock:
+            row = self.con.execute(query, args).fetchone()
+        return list(row) if row[0] else None
+
+    def rollup(self, photon_key: int, resolution: int, date_from: int = None, date_to: int = None) -> list:
+        """
+        Return the rollup buckets of a photon at one of the ROLLUP_RESOLUTIONS, ordered by date, optionally only
+        the buckets overlapping date_from to date_to
+
+        :return: list of {date: bucket start, count, min, max, mean}
+        """
+        query = "SELECT bucket, count, sum, min, max FROM rollup WHERE id = ? AND resolution = ?"
+        args = [photon_key, resolution]
+        if date_from is not None:
+            query += " AND bucket >= ?"
+            args.append(date_from - date_from % resolution)
+        if date_to is not None:
+            query += " AND bucket < ?"
+            args.append(date_to)
+        with self.lock:
+            rows = self.con.execute(query + " ORDER BY bucket", args).fetchall()
+        return [point(x[0], list(x[1:])) for x in rows]
+
+    def latest(self, photon_key: int):
+        """Return the newest row stored for a photon or None"""
+        with self.lock:
+            return self.con.execute("SELECT * FROM measurement WHERE id = ? ORDER BY seq DESC LIMIT 1",
+                                    [photon_key]).fetchone()
+
+    def close(self):
+        with self.lock:
+            self.con.close()
@@ -0,0 +1,328 @@
+import mmap
+import os
+import shutil
+import sqlite3 as sql
+import struct
+import sys
+import threading
+from datetime import datetime
+
+from chord.rollup import Rollups, aggregate, merge
+from config import CLEAR_STORAGE, SEGMENT_RECORDS, SEGMENT_MMAP, SEGMENT_READ_CHUNK
+
+# One measurement on disk: sequence number, epoch timestamp in milliseconds and the value
+RECORD = struct.Struct('<qqq')
+
+
+class Segment:
+    """
+    An append-only file holding up to SEGMENT_RECORDS measurements of one photon. The records have a fixed size and
+    are ordered by sequence number, so the record after a sequence number is found with a binary search.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self.min_date = None
+        self.max_date = None
+        self.max_seq = 0
+        self.last = None
+        self.summary = None  # [count, sum, min, max] of the values
+        if os.path.exists(path):
+            records = self.read()
+            self.count = len(records)
+            for record in records:
+                self._track(record)
+            # Drop a partially written trailing record, otherwise the next append would be misaligned
+            if os.path.getsize(path) != self.count * RECORD.size:
+                os.truncate(path, self.count * RECORD.size)
+
+    def _track(self, record: tuple):
+        seq, date, data = record
+        self.max_seq = max(self.max_seq, seq)
+        self.min_date = date if self.min_date is None else min(self.min_date, date)
+        self.max_date = date if self.max_date is None else max(self.max_date, date)
+        self.last = record
+        if self.summary is None:
+            self.summary = [1, data, data, data]
+        else:
+            merge(self.summary, [1, data, data, data])
+
+    def append(self, records: list):
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(RECORD.pack(*record) for record in records))
+        self.count += len(records)
+        for record in records:
+            self._track(record)
+
+    def read(self, start: int = 0, stop: int = None) -> list:
+        """Decode the records from index start up to stop, by default all of them"""
+        size = os.path.getsize(self.path)
+        size -= size % RECORD.size  # Ignore a partially written trailing record
+        end = size if stop is None else min(stop * RECORD.size, size)
+        begin = start * RECORD.size
+        if begin >= end:
+            return []
+        with open(self.path, 'rb') as f:
+            if SEGMENT_MMAP:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    # Unpack from a view of the mapping, such that only the requested records are touched
+                    with memoryview(m) as view:
+                        return list(RECORD.iter_unpack(view[begin:end]))
+            f.seek(begin)
+            return list(RECORD.iter_unpack(f.read(end - begin)))
+
+    def find(self, seq: int) -> int:
+        """Return the index of the first record with a sequence number larger than seq"""
+        if self.count == 0 or seq >= self.max_seq:
+            return self.count
+        with open(self.path, 'rb') as f:
+            if SEGMENT_MMAP:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    return self._bisect(lambda i: RECORD.unpack_from(m, i * RECORD.size)[0], seq)
+
+            def seq_at(i):
+                f.seek(i * RECORD.size)
+                return RECORD.unpack(f.read(RECORD.size))[0]
+            return self._bisect(seq_at, seq)
+
+    def _bisect(self, seq_at, seq: int) -> int:
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if seq_at(middle) <= seq:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+class SegmentStorage:
+    """
+    Time-series storage of measurements in compact, chunked, append-only segment files.
+
+    Every photon gets a directory data/<port>/<key>/ of numbered segment files, with 24 bytes per measurement.
+    The date and sequence number range of each segment is kept in memory, so range reads only touch the segments
+    that can contain matching measurements. Dates are integer epoch milliseconds and keys are integers. Sequence
+    numbers work as in the sqlite Storage.
+
+    The rollups are kept in memory, they are rebuilt from the segments on start and updated on every append.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.segments = {}
+        self.rollups = Rollups()
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            if name.isdigit():
+                self._load(int(name))
+
+    @classmethod
+    def for_port(cls, port: int) -> 'SegmentStorage':
+        return cls('data/' + str(port))
+
+    def _photon_path(self, photon_key: int) -> str:
+        return os.path.join(self.path, str(photon_key))
+
+    def _load(self, photon_key: int):
+        path = self._photon_path(photon_key)
+        names = sorted(x for x in os.listdir(path) if x.endswith('.seg'))
+        self.segments[photon_key] = [Segment(os.path.join(path, name)) for name in names]
+        for segment in self.segments[photon_key]:
+            self.rollups.add(aggregate((photon_key, date, data) for seq, date, data in segment.read()))
+
+    def _segments(self, photon_key: int) -> list:
+        if photon_key not in self.segments:
+            os.makedirs(self._photon_path(photon_key), exist_ok=True)
+            self.segments[photon_key] = []
+        return self.segments[photon_key]
+
+    def clear(self):
+        with self.lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path, exist_ok=True)
+            self.segments = {}
+            self.rollups.clear()
+
+    def _last_seq(self, photon_key: int) -> int:
+        segments = self.segments.get(photon_key)
+        return segments[-1].max_seq if segments else 0
+
+    def last_seq(self, photon_key: int) -> int:
+        """Return the sequence number of the newest measurement of a photon, 0 if there is none"""
+        with self.lock:
+            return self._last_seq(photon_key)
+
+    def _append(self, photon_key: int, records: list):
+        self.rollups.add(aggregate((photon_key, date, data) for seq, date, data in records))
+        segments = self._segments(photon_key)
+        while records:
+            if not segments or segments[-1].count >= SEGMENT_RECORDS:
+                name = '{0:08d}.seg'.format(len(segments))
+                segments.append(Segment(os.path.join(self._photon_path(photon_key), name)))
+            free = SEGMENT_RECORDS - segments[-1].count
+            segments[-1].append(records[:free])
+            records = records[free:]
+
+    def insert(self, rows: list) -> list:
+        """
+        Append a batch of newly collected (date, id, data) rows
+
+        :return: the inserted rows as (seq, date, id, data)
+        """
+        result = []
+        with self.lock:
+            by_photon = {}
+            for date, photon_key, data in rows:
+                photon_key = int(photon_key)
+                records = by_photon.setdefault(photon_key, [])
+                seq = self._last_seq(photon_key) + len(records) + 1
+                records.append((seq, int(date), int(data)))
+                result.append((seq, int(date), photon_key, int(data)))
+            for photon_key, records in by_photon.items():
+                self._append(photon_key, records)
+        return result
+
+    def insert_replicated(self, rows: list) -> int:
+        """
+        Append (seq, date, id, data) rows received from the master of the photons, keeping their sequence numbers.
+        Rows which are already stored are skipped.
+
+        :return: the number of inserted rows
+        """
+        count = 0
+        with self.lock:
+            by_photon = {}
+            for seq, date, photon_key, data in rows:
+                by_photon.setdefault(int(photon_key), []).append((int(seq), int(date), int(data)))
+            for photon_key, records in by_photon.items():
+                last_seq = self._last_seq(photon_key)
+                new_records = []
+                for record in sorted(records):
+                    if record[0] > last_seq:
+                        last_seq = record[0]
+                        new_records.append(record)
+                self._append(photon_key, new_records)
+                count += len(new_records)
+        return count
+
+    def after(self, photon_key: int, cursor: int, limit: int, date_from: int = None, date_to: int = None) -> list:
+        """
+        Return up to limit rows of a photon with a sequence number larger than cursor, ordered by seq. Optionally
+        only rows dated at or after date_from and before date_to are returned.
+        """
+        date_from = date_from if date_from is not None else -2 ** 63
+        date_to = date_to if date_to is not None else 2 ** 63
+        result = []
+        with self.lock:
+            for segment in self.segments.get(photon_key, []):
+                if segment.max_seq <= cursor or segment.count == 0:
+                    continue
+                # Segments outside the time range are skipped without reading them
+                if segment.max_date < date_from or segment.min_date >= date_to:
+                    continue
+                # Only the records after the cursor are read, in chunks of at least the rest of the page
+                index = segment.find(cursor)
+                while index < segment.count:
+                    records = segment.read(index, index + max(limit - len(result), SEGMENT_READ_CHUNK))
+                    if not records:
+                        break
+                    index += len(records)
+                    for seq, date, data in records:
+                        if date_from <= date < date_to:
+                            result.append({'seq': seq, 'date': date, 'id': photon_key, 'data': data})
+                            if len(result) >= limit:
+                                return result
+        return result
+
+    def summarise(self, photon_key: int, date_from: int = None, date_to: int = None) -> list:
+        """
+        Return the [count, sum, min, max] of the values of a photon dated at or after date_from and before date_to,
+        or None if there are none. Segments entirely inside the range are summarised without reading them.
+        """
+        date_from = date_from if date_from is not None else -2 ** 63
+        date_to = date_to if date_to is not None else 2 ** 63
+        result = None
+        with self.lock:
+            for segment in self.segments.get(photon_key, []):
+                if segment.count == 0 or segment.max_date < date_from or segment.min_date >= date_to:
+                    continue
+                if date_from <= segment.min_date and segment.max_date < date_to:
+                    values = [segment.summary]
+                else:
+                    values = [[1, data, data, data] for seq, date, data in segment.read() if date_from <= date < date_to]
+                for value in values:
+                    if result is None:
+                        result = list(value)
+                    else:
+                        merge(result, value)
+        return result
+
+    def rollup(self, photon_key: int, resolution: int, date_from: int = None, date_to: int = None) -> list:
+        """
+        Return the rollup buckets of a photon at one of the ROLLUP_RESOLUTIONS, ordered by date, optionally only
+        the buckets overlapping date_from to date_to
+
+        :return: list of {date: bucket start, count, min, max, mean}
+        """
+        with self.lock:
+            return self.rollups.query(photon_key, resolution, date_from, date_to)
+
+    def latest(self, photon_key: int):
+        """Return the newest row stored for a photon or None"""
+        with self.lock:
+            segments = self.segments.get(photon_key)
+            if not segments or segments[-1].last is None:
+                return None
+            seq, date, data = segments[-1].last
+        return {'seq': seq, 'date': date, 'id': photon_key, 'data': data}
+
+    def close(self):
+        pass
+
+
+def parse_date(value) -> int:
+    """Convert a date as stored by older versions (datetime text or epoch) to epoch milliseconds"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    if value.isdigit():
+        return int(value)
+    for date_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return int(datetime.strptime(value, date_format).timestamp() * 1000)
+        except ValueError:
+            continue
+    raise ValueError('Unknown date format: {0}'.format(value))
+
+
+def migrate_sqlite(db_path: str, storage: SegmentStorage, batch_size: int = 10000) -> int:
+    """
+    Copy all measurements of an existing data/<port>.db file into segment storage
+
+    :param db_path: path of the sqlite database
+    :param storage: the storage to copy the measurements to
+    :param batch_size: number of rows inserted at a time
+    :return: the number of migrated rows
+    """
+    con = sql.connect(db_path)
+    cur = con.execute('SELECT date, id, data FROM measurement ORDER BY id, date')
+    count = 0
+    while True:
+        rows = cur.fetchmany(batch_size)
+        if not rows:
+            break
+        storage.insert([(parse_date(date), int(photon_key), data) for date, photon_key, data in rows])
+        count += len(rows)
+    con.close()
+    return count
+
+
+if __name__ == '__main__':
+    # Usage: python3 -m chord.timeseries <port>
+    port = int(sys.argv[1])
+    migrated = migrate_sqlite('data/' + str(port) + '.db', SegmentStorage.for_port(port))
+    print('Migrated {0} measurements to data/{1}/'.format(migrated, port))
+    if CLEAR_STORAGE:
+        print('Set CLEAR_STORAGE = False in config.py, otherwise the node deletes them when it starts')
@@ -0,0 +1,101 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from config import RPC_CONNECT_TIMEOUT, RPC_READ_TIMEOUT, RPC_RETRIES, RPC_POOL_PEERS, RPC_POOL_SIZE, RTT_ALPHA
+
+
+class Transport:
+    """
+    Shared HTTP transport used for all requests a node makes to its peers.
+
+    Connections are kept alive and pooled per peer (one pool per ip:port), every request gets a connect and
+    read timeout, and connection failures are retried a limited number of times.
+
+    The round trip time of every successful request is smoothed per peer (EWMA), unless the request is made with
+    measure=False because the peer does more than answer it, e.g. forwarding a lookup.
+    """
+
+    def __init__(self, connect_timeout: float = RPC_CONNECT_TIMEOUT, read_timeout: float = RPC_READ_TIMEOUT,
+                 retries: int = RPC_RETRIES, pool_peers: int = RPC_POOL_PEERS, pool_size: int = RPC_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(pool_connections=pool_peers,
+                                   pool_maxsize=pool_size,
+                                   max_retries=Retry(total=retries, read=0, backoff_factor=0.05))
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.timeouts = 0
+        self.failures = 0
+        self.rtts = {}  # 'ip:port' -> smoothed round trip time in seconds
+        self._lock = threading.Lock()
+        # Connections and requests of the pools urllib3 evicted, once more than pool_peers peers are contacted
+        self.evicted_connections = 0
+        self.evicted_requests = 0
+        pools = self.adapter.poolmanager.pools
+        close = pools.dispose_func
+
+        def dispose(pool):
+            with self._lock:
+                self.evicted_connections += pool.num_connections
+                self.evicted_requests += pool.num_requests
+            # Older urllib3 versions close evicted pools here, newer ones leave them to the garbage collector
+            if close is not None:
+                close(pool)
+        pools.dispose_func = dispose
+
+    def request(self, method: str, url: str, measure: bool = True, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            start = time.time()
+            response = self.session.request(method, url, **kwargs)
+            if measure:
+                self._observe(urlsplit(url).netloc, time.time() - start)
+            return response
+        except requests.exceptions.Timeout:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        except requests.exceptions.RequestException:
+            with self._lock:
+                self.failures += 1
+            raise
+
+    def _observe(self, peer: str, sample: float):
+        with self._lock:
+            rtt = self.rtts.get(peer)
+            self.rtts[peer] = sample if rtt is None else (1 - RTT_ALPHA) * rtt + RTT_ALPHA * sample
+
+    def rtt(self, ip: str, port: int) -> float:
+        """Return the smoothed round trip time to a peer in seconds, or None if it has not been measured"""
+        return self.rtts.get('{0}:{1}'.format(ip, port))
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request('POST', url, **kwargs)
+
+    def stats(self) -> dict:
+        """Return counters for connections opened and reused, timeouts and other failures"""
+        with self._lock:
+            opened = self.evicted_connections
+            served = self.evicted_requests
+        pools = self.adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            opened += pool.num_connections
+            served += pool.num_requests
+        return {'peers': len(pools),
+                'connections_opened': opened,
+                'connections_reused': max(served - opened, 0),
+                'requests': served,
+                'timeouts': self.timeouts,
+                'failures': self.failures,
+                'rtt_ms': {peer: round(rtt * 1000, 2) for peer, rtt in list(self.rtts.items())}}
@@ -1,8 +1,10 @@
 import hashlib
-import math
 
 from config import INTERVAL
 
+# Number of identifiers on the ring: keys of INTERVAL decimal digits, or the full sha-256 hash if INTERVAL is None
+RING_SIZE = 10 ** INTERVAL if INTERVAL is not None else 2 ** 256
+
 
 def encode_address(ip: str, port: int) -> int:
     """
@@ -25,13 +27,18 @@ def encode_key(key: str, size=INTERVAL) -> int:
     """
     res = int(hashlib.sha256(key.encode('utf-8')).hexdigest(), base=16)
     if size is not None:
-        res //= int((math.pow(10, (int(math.log10(res)) + 1 - size))))
+        res //= 10 ** (len(str(res)) - size)
     return res
 
 
+def distance(start: int, stop: int) -> int:
+    """Calculate the clockwise distance from start to stop on the ring"""
+    return (stop - start) % RING_SIZE
+
+
 def in_interval(start: int, stop: int, key: int):
     """Calculate if key is within the interval of start and stop"""
     if start < stop:
         return start < key <= stop
     else:
-        return start < key < pow(10, INTERVAL) or 0 <= key <= stop
\ No newline at end of file
+        return start < key < RING_SIZE or 0 <= key <= stop
\ No newline at end of file
@@ -1,7 +1,86 @@
 INTERVAL = 4
 SUCCESSOR_LIST_SIZE = 3
+LOOKUP_MAX_HOPS = 32
+LOOKUP_CACHE_SIZE = 256
+LOOKUP_CACHE_TTL = 30
+# Lookup request ids are remembered this long for loop detection, at most LOOKUP_REQUESTS_SIZE of them
+LOOKUP_REQUESTS_EXPIRY = 30
+LOOKUP_REQUESTS_SIZE = 4096
+# The slow lookup path tries at most this many nodes of the successor list, and gives up after the deadline
+LOOKUP_SLOW_ATTEMPTS = 3
+LOOKUP_SLOW_DEADLINE = 10.0
+# A finger which failed to answer a forwarded lookup is not used as a hop for this many seconds
+FAILED_HOP_EXPIRY = 60
+COLLECT_WORKERS = 16
+FINGER_WORKERS = 8
+# 'batch' refreshes all fingers concurrently in every fix_fingers run, 'single' refreshes one finger per run
+FINGER_REPAIR = 'batch'
+REPLICATION_BATCH = 500
+# Number of successors every photon is replicated to, at most SUCCESSOR_LIST_SIZE
+REPLICATION_FACTOR = 2
+# Rows per transaction when inserting the history streamed during a photon handoff
+HANDOFF_BATCH = 5000
+# Read timeout for handing over photons when leaving, the successor streams their history before answering
+HANDOFF_TIMEOUT = 300
+# Seconds a node waits after answering /leave before it exits
+LEAVE_EXIT_DELAY = 1
+# Default number of measurements in a page of /photon/<key>
+PHOTON_PAGE_SIZE = 1000
+# Measurements are rolled up per minute, hour and day (ms), graphs show at most GRAPH_POINTS points
+ROLLUP_RESOLUTIONS = (60 * 1000, 60 * 60 * 1000, 24 * 60 * 60 * 1000)
+GRAPH_POINTS = 500
+# Routed photon queries fall back to a replica if the owner does not answer within this many seconds
+ROUTE_TIMEOUT = 2.0
+# Ring-wide aggregates answer within AGGREGATE_DEADLINE seconds, every level of the broadcast keeps a margin
+AGGREGATE_DEADLINE = 5.0
+AGGREGATE_MARGIN = 0.25
+# Push new measurements to the backups right after collection. Backups only poll a master when no push has
+# arrived for PUSH_GRACE seconds.
+REPLICATION_PUSH = True
+PUSH_GRACE = 10
+
+# Inter-node RPC transport
+RPC_CONNECT_TIMEOUT = 1.0
+RPC_READ_TIMEOUT = 5.0
+RPC_RETRIES = 2
+RPC_POOL_PEERS = 32
+RPC_POOL_SIZE = 8
+# 'threaded' serves every request on its own thread of the Flask server. 'async' answers the ring RPCs on an
+# asyncio event loop (needs aiohttp) and serves the other routes with Flask on a pool of RPC_WORKERS threads
+SERVER_MODE = 'threaded'
+RPC_WORKERS = 32
+# Weight of a new sample in the smoothed round trip time of a peer
+RTT_ALPHA = 0.2
+# Choose the next lookup hop among the fingers and successor list by estimated latency, not only by key distance
+PROXIMITY_ROUTING = True
+
+# Measurement storage: 'segments' (chord.timeseries) or 'sqlite' (chord.storage)
+STORAGE_BACKEND = 'segments'
+# Delete the stored measurements when a node starts. Set to False to keep them, e.g. after migrating a database
+# with python3 -m chord.timeseries <port>
+CLEAR_STORAGE = True
+SEGMENT_RECORDS = 4096
+SEGMENT_MMAP = True
+# Records decoded at a time when reading a segment after a cursor
+SEGMENT_READ_CHUNK = 256
+
+# Maintenance schedule: task name -> (interval in seconds, random jitter in seconds, max concurrent runs)
+MAINTENANCE_SCHEDULE = {
+    'stabilize': (2, 2, 1),
+    'update_successor_list': (2, 2, 1),
+    'check_predecessor': (2, 2, 1),
+    'fix_fingers': (2, 2, 1),
+    'collect_data': (3, 1, 1),
+    'poll_data': (3, 1, 1),
+    'check_backups': (4, 2, 1),
+}
+
+# Ring maintenance tasks back off exponentially up to the max interval while the ring state is unchanged
+ADAPTIVE_TASKS = ('stabilize', 'check_predecessor', 'fix_fingers')
+ADAPTIVE_BACKOFF = 2
+ADAPTIVE_MAX_INTERVAL = 32
 
 
 class Config(object):
     DEBUG = False
-    SECRET_KEY = 'insecurekeyfordev'
\ No newline at end of file
+    SECRET_KEY = 'insecurekeyfordev'
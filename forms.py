@@ -2,6 +2,7 @@ from flask_wtf import Form
 from wtforms import (
     StringField,
     IntegerField,
+    BooleanField,
     SubmitField
 )
 from wtforms.validators import (
@@ -24,4 +25,5 @@ class AddForm(Form):
 
 class SearchForm(Form):
     key = IntegerField('Key', validators=[DataRequired(), NumberRange(min=1, max=65535)])
+    iterative = BooleanField('Iterative lookup', default=False)
     submit = SubmitField('Search')
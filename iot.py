@@ -1,8 +1,10 @@
 import sys
-import random
+import itertools
 import logging
-import sqlite3 as sql
 import json
+import os
+import signal
+import threading
 
 from flask import (
     Flask,
@@ -11,23 +13,37 @@ from flask import (
     flash,
     redirect,
     url_for,
-    request
+    request,
+    Response
 )
 
+from chord.maintenance import MaintenanceEngine
 from chord.node import Node
-from chord.util import encode_key
-from config import Config
+from chord.storage import open_storage
+from chord.util import encode_key, in_interval
+from config import (
+    Config,
+    LOOKUP_MAX_HOPS,
+    REPLICATION_BATCH,
+    PHOTON_PAGE_SIZE,
+    GRAPH_POINTS,
+    AGGREGATE_DEADLINE,
+    SERVER_MODE,
+    CLEAR_STORAGE,
+    LEAVE_EXIT_DELAY,
+    MAINTENANCE_SCHEDULE,
+    ADAPTIVE_TASKS,
+    ADAPTIVE_BACKOFF,
+    ADAPTIVE_MAX_INTERVAL
+)
 from forms import JoinForm, SearchForm, AddForm
 from util import get_free_port, parse_docstring
-from concurrent.futures import ThreadPoolExecutor
-from time import sleep
-
-executor = ThreadPoolExecutor(2)
 
 app = Flask(__name__)
 app.config.from_object(Config())
 
 node = None
+engine = None
 
 
 log = logging.getLogger('werkzeug')
@@ -116,6 +132,9 @@ def find_successor_counting(key, start_key, count):
 
     :param key: they key to search for
     :param start_key: key for peer starting the request
+    :param count: number of hops so far
+    :param rid: id of the lookup, used to detect loops. A new lookup is started if it is missing.
+    :param ttl: number of hops the lookup may still take
     :returns: {'successor': true, 'key': successor.key, 'ip': successor.ip, 'port': successor.port,
     'msg': message explaining the request } if success,
     otherwise {'successor': false, 'error': error message}
@@ -123,7 +142,9 @@ def find_successor_counting(key, start_key, count):
     if node.key == start_key:
         return jsonify({'successor': False, 'error': 'node.key == start key == {0}'.format(start_key)})
 
-    successor_node, msg, count = node.find_successor(key, start_key, count)
+    successor_node, msg, count = node.find_successor(key, start_key, count,
+                                                     request_id=request.args.get('rid'),
+                                                     ttl=int(request.args.get('ttl', LOOKUP_MAX_HOPS)))
     if successor_node:
         return jsonify({'successor': True,
                         'key': successor_node.key,
@@ -146,7 +167,9 @@ def notify():
     """
     pred_ip = request.form.get('ip')
     pred_port = request.form.get('port')
-    node.notify(Node(pred_ip, pred_port))
+    if node.notify(Node(pred_ip, pred_port)):
+        # A new predecessor has joined, leave slow maintenance mode
+        engine.reset()
     return jsonify({'success': True})
 
 
@@ -165,6 +188,7 @@ def join():
         join_ip = request.form.get('ip')
         join_port = request.form.get('port')
         node.join(join_ip, join_port)
+        engine.reset()
         flash('Successfully join network', 'success')
         return redirect(url_for('home'))
     search_form = SearchForm()
@@ -234,6 +258,86 @@ def give_photons():
     return jsonify({'photons': result})
 
 
+@app.route('/handoff_data', methods=['POST'])
+def handoff_data():
+    """Handoff data
+
+    Stream the stored history of several photons. This endpoint is used when photons are handed over to another node,
+    e.g. during join. It is only intended that this endpoint is used by other nodes and not by users.
+
+    :param cursors: JSON object mapping photon keys to the sequence number after which the history should start.
+    :returns: gzip compressed, newline delimited JSON stream of measurements {seq: int, date: epoch ms, id: key, data: value}
+    """
+    payload = request.get_json(silent=True)
+    if payload is None or payload.get('cursors') is None:
+        return jsonify({'success': False, 'msg': 'Invalid arguments'})
+    return Response(node.handoff_stream(payload['cursors']), mimetype='application/gzip')
+
+
+@app.route('/leave', methods=['POST'])
+def leave():
+    """Leave
+
+    Leave the chord-network gracefully. The photons and their measurements are handed over to the successor, and the
+    predecessor and successor are linked up with each other.
+
+    :returns: {'success': bool}, false if the successor could not take over the photons. On success the node stops
+        its maintenance and exits right after answering, so it does not rejoin the ring without its photons.
+    """
+    success = node.depart()
+    if success:
+        engine.stop()
+        threading.Timer(LEAVE_EXIT_DELAY, os._exit, [0]).start()
+    return jsonify({'success': success})
+
+
+@app.route('/leaving', methods=['POST'])
+def leaving():
+    """Leaving
+
+    Tell a node that its successor or predecessor is leaving the network. It is only intended that this endpoint is
+    used by other nodes and not by users.
+
+    :param ip: the leaving node's ip
+    :param port: the leaving node's port
+    :param successor_ip: the leaving node's successor ip
+    :param successor_port: the leaving node's successor port
+    :param predecessor_ip: the leaving node's predecessor ip, if it has one
+    :param predecessor_port: the leaving node's predecessor port, if it has one
+    :returns: {'success': True}
+    """
+    leaving_node = Node(request.form.get('ip'), request.form.get('port'))
+    successor_node = Node(request.form.get('successor_ip'), request.form.get('successor_port'))
+    predecessor_node = None
+    if request.form.get('predecessor_ip') is not None:
+        predecessor_node = Node(request.form.get('predecessor_ip'), request.form.get('predecessor_port'))
+    node.handle_leaving(leaving_node, successor_node, predecessor_node)
+    engine.reset()
+    return jsonify({'success': True})
+
+
+@app.route('/take_photons', methods=['POST'])
+def take_photons():
+    """Take photons
+
+    This endpoint is used when a node leaves. The caller hands over its photons, and this node pulls their
+    measurements from it before answering. It is only intended that this endpoint is used by other nodes and not by users.
+
+    :param ip: the leaving node's ip
+    :param port: the leaving node's port
+    :param photon_ids: JSON list of the particle-io ids of the photons which are handed over.
+    :returns: {'success': True} or {'success': False, 'msg': error message} if the measurements could not be pulled
+    """
+    payload = request.get_json(silent=True)
+    if payload is None or payload.get('photon_ids') is None:
+        return jsonify({'success': False, 'msg': 'Invalid arguments'})
+    try:
+        node.take_photons(Node(payload['ip'], payload['port']), payload['photon_ids'])
+    except Exception as e:
+        return jsonify({'success': False, 'msg': str(e)})
+    return jsonify({'success': True})
+
+
 @app.route('/add_backup', methods=['POST'])
 def add_backup():
     """Add backup
@@ -258,56 +362,223 @@ def add_backup():
 def get_latest_data():
     """Get latest photon data
 
-    Return the latest data collected by a photon.
+    Return the photon data stored after a cursor. Every measurement has a sequence number which increases per photon,
+    so a backup only has to remember the sequence number of the last measurement it received.
 
-    :param last_request: a timestamp for when the last request was sent or the time of the newest data stored locally.
+    :param cursor: the sequence number of the last measurement the caller has, 0 to start from the beginning.
+    :param limit: the maximum number of measurements to return.
     :param photon_key: the key of the photon
     :param request_id: the identity/key of the caller. This is used to tell whether the requester is backup for the photon
-    :return: JSON-response: {'success': bool, 'is_backup': bool, 'msg': data}, where data is a list [{date: '...', id: '..', data: ''}, ...]
+    :return: JSON-response: {'success': bool, 'is_backup': bool, 'msg': data, 'cursor': int, 'more': bool}, where data is
+    a list [{seq: int, date: epoch ms, id: key, data: value}, ...], cursor is the sequence number of the last
+    measurement returned and more tells whether there are more measurements after it.
     """
-    if request.args.get('last_request') is None or \
+    if request.args.get('cursor') is None or \
             request.args.get('photon_key') is None or \
             request.args.get('request_id') is None:
         return jsonify({'success': False, 'msg': 'Invalid arguments'})
 
     photon_key = int(request.args.get('photon_key'))
-    last_request = request.args.get('last_request')
+    cursor = int(request.args.get('cursor'))
+    limit = min(int(request.args.get('limit', REPLICATION_BATCH)), REPLICATION_BATCH)
     request_id = int(request.args.get('request_id'))
-    is_backup, data = node.get_latest_data(photon_key, last_request, request_id)
+    is_backup, data, cursor, more = node.get_latest_data(photon_key, cursor, request_id, limit)
+
+    return jsonify({'success': True, 'is_backup': is_backup, 'msg': data, 'cursor': cursor, 'more': more})
+
+
+@app.route('/get_latest_data_batch', methods=['POST'])
+def get_latest_data_batch():
+    """Get latest photon data in batch
+
+    Return the photon data stored after a cursor for several photons in one request. This is used by backups to poll
+    all the photons they hold for a master at once.
+
+    :param cursors: JSON object mapping photon keys to the sequence number of the last measurement the caller has.
+    :param limit: the maximum number of measurements to return per photon.
+    :param request_id: the identity/key of the caller. This is used to tell whether the requester is backup for the photons
+    :return: JSON-response: {'success': bool, 'photons': {photon_key: {'is_backup': bool, 'msg': data, 'cursor': int,
+    'more': bool}, ...}}, with the same fields per photon as /get_latest_data
+    """
+    payload = request.get_json(silent=True)
+    if payload is None or payload.get('cursors') is None or payload.get('request_id') is None:
+        return jsonify({'success': False, 'msg': 'Invalid arguments'})
+
+    limit = min(int(payload.get('limit', REPLICATION_BATCH)), REPLICATION_BATCH)
+    result = node.get_latest_data_batch(payload['cursors'], int(payload['request_id']), limit)
+    return jsonify({'success': True, 'photons': result})
+
+
+@app.route('/push_data', methods=['POST'])
+def push_data():
+    """Push photon data
+
+    Receive measurements pushed by the master of the photons right after they were collected. It is only intended
+    that this endpoint is used by other nodes and not by users.
+
+    :param ip: the masters ip
+    :param port: the masters port
+    :param photons: JSON object mapping photon keys to lists of measurements [{seq: int, date: epoch ms, id: key, data: value}, ...]
+    :return: JSON-response: {'success': bool, 'photons': {photon_key: cursor, ...}} with the new cursor of every photon
+    for which the push was accepted. Photons that are missing must be pulled by the backup.
+    """
+    payload = request.get_json(silent=True)
+    if payload is None or payload.get('photons') is None:
+        return jsonify({'success': False, 'msg': 'Invalid arguments'})
 
-    return jsonify({'success': True, 'is_backup': is_backup, 'msg': data})
+    acks = node.receive_push(Node(payload['ip'], payload['port']), payload['photons'])
+    return jsonify({'success': True, 'photons': acks})
 
 
 @app.route('/photon/<int:key>', methods=['GET'])
 def get_photon_data(key: int):
     """Get photon data
 
-    Retrieve all photon data stored locally at a node
+    Retrieve a page of the photon data stored locally at a node, either as master or as one of the replicas of the
+    photon. The measurements are streamed from the storage, ordered by their sequence number. The seq of the last
+    measurement is the cursor of the next page, a page with less than limit measurements is the last one.
 
     :param key: the key of the photon.
-    :returns: {'success': False, 'msg': 'No data for this photon key'} or {'success': True, 'msg': result}, where result is a list [{date: '...', id: '..', data: ''}, ...]
+    :param from: optional, only measurements dated at or after this epoch ms.
+    :param to: optional, only measurements dated before this epoch ms.
+    :param cursor: optional, only measurements with a sequence number larger than cursor.
+    :param limit: optional, the maximum number of measurements, default PHOTON_PAGE_SIZE. 0 returns all of them.
+    :param format: optional, 'json' (default) or 'ndjson' for one measurement per line.
+    :param points: optional, summarise the measurements with at most this many points instead, from the rollups.
+    :returns: {'success': False, 'msg': 'No data for this photon key'} with status 404 or {'success': True, 'msg': result, 'cursor': seq, 'more': bool}, where result is a list [{seq: int, date: epoch ms, id: key, data: value}, ...]. With points {'success': True, 'resolution': bucket width in ms (0 for raw measurements), 'msg': [{date: epoch ms, count: int, min: value, max: value, mean: value}, ...]}
     """
-    result = node.get_photon_data(key)
-    if result is None:
-        return jsonify({'success': False, 'msg': 'No data for this photon key'})
-    return jsonify({'success': True, 'msg': result})
+    points = request.args.get('points', None, type=int)
+    limit = request.args.get('limit', PHOTON_PAGE_SIZE, type=int)
+    if limit < 0 or (points is not None and points < 0):
+        return jsonify({'success': False, 'msg': 'Invalid arguments'})
+    if points:
+        result = node.get_photon_points(key, request.args.get('from', None, type=int),
+                                        request.args.get('to', None, type=int), points)
+        if result is None:
+            return jsonify({'success': False, 'msg': 'No data for this photon key'}), 404
+        return jsonify({'success': True, 'resolution': result[0], 'msg': result[1]})
+
+    # One row more than the page tells whether there is a next page
+    rows = node.get_photon_data(key,
+                                cursor=request.args.get('cursor', 0, type=int),
+                                date_from=request.args.get('from', None, type=int),
+                                date_to=request.args.get('to', None, type=int),
+                                limit=limit + 1 if limit > 0 else None)
+    if rows is None:
+        return jsonify({'success': False, 'msg': 'No data for this photon key'}), 404
+
+    if request.args.get('format') == 'ndjson':
+        return Response((json.dumps(row) + '\n' for row in itertools.islice(rows, limit or None)),
+                        mimetype='application/x-ndjson')
+
+    def generate(cursor):
+        yield '{"success": true, "msg": ['
+        more = False
+        for i, row in enumerate(rows):
+            if limit and i == limit:
+                more = True
+                break
+            yield (',' if i else '') + json.dumps(row)
+            cursor = row['seq']
+        yield '], "cursor": {0}, "more": {1}}}'.format(cursor, json.dumps(more))
+    return Response(generate(request.args.get('cursor', 0, type=int)), mimetype='application/json')
+
+
+@app.route('/query/photon/<int:key>', methods=['GET'])
+def query_photon_data(key: int):
+    """Query photon data
+
+    Retrieve photon data from any node in the network. The node responsible for the photon is looked up, and the
+    query is sent to it, or to one of the replicas of the photon if it does not answer in time.
+
+    :param key: the key of the photon.
+    :param mode: optional, 'proxy' (default) streams the answer through this node, 'redirect' redirects the client to the node responsible for the photon.
+    :returns: the answer of /photon/<key> at the node responsible or a replica, with the same query arguments, or {'success': False, 'msg': error message}
+    """
+    params = request.args.to_dict()
+    if params.pop('mode', 'proxy') == 'redirect':
+        owner, msg, count = node.find_successor(key, node.key)
+        if owner is None:
+            return jsonify({'success': False, 'msg': msg})
+        return redirect('http://{0}:{1}{2}'.format(owner.ip, owner.port, url_for('get_photon_data', key=key, **params)))
+
+    answered_by, response = node.route_photon_query(key, params)
+    if answered_by is None:
+        return jsonify({'success': False, 'msg': response})
+    return Response(response.iter_content(chunk_size=None),
+                    content_type=response.headers.get('Content-Type'),
+                    headers={'X-Photon-Node': '{0}:{1}'.format(answered_by.ip, answered_by.port)})
+
+
+@app.route('/aggregate', methods=['GET'])
+def aggregate():
+    """Aggregate
+
+    Aggregate the measurements of all photons in the network, e.g. the average light value over the last hour. The
+    query is broadcast through the finger tables, every node aggregates its own photons and the results are merged
+    on the way back. Nodes which do not answer before the deadline are left out and listed as missing.
+
+    :param from: optional, only measurements dated at or after this epoch ms.
+    :param to: optional, only measurements dated before this epoch ms.
+    :param deadline: optional, seconds to wait for the answers of the other nodes, default AGGREGATE_DEADLINE.
+    :returns: {'count': int, 'mean': value, 'min': value, 'max': value, 'photons': int, 'nodes': int, 'missing': [nodes], 'complete': bool}
+    """
+    result = node.aggregate(request.args.get('from', None, type=int), request.args.get('to', None, type=int),
+                            node.key, request.args.get('deadline', AGGREGATE_DEADLINE, type=float))
+    count, total, low, high = result['summary'] or [0, 0, None, None]
+    return jsonify({'count': count,
+                    'mean': total / count if count else None,
+                    'min': low,
+                    'max': high,
+                    'photons': result['photons'],
+                    'nodes': result['nodes'],
+                    'missing': result['missing'],
+                    'complete': not result['missing']})
+
+
+@app.route('/aggregate/broadcast', methods=['POST'])
+def aggregate_broadcast():
+    """Aggregate broadcast
+
+    Aggregate the measurements of the photons of every node from this node up to a limit, as part of an aggregate
+    query. It is only intended that this endpoint is used by other nodes and not by users.
+
+    :param from: epoch ms or null.
+    :param to: epoch ms or null.
+    :param limit: the key of the first node not included.
+    :param budget: seconds left to answer.
+    :returns: {'summary': [count, sum, min, max] or null, 'photons': int, 'nodes': int, 'missing': [nodes]}
+    """
+    payload = request.get_json(silent=True)
+    if payload is None or payload.get('limit') is None or payload.get('budget') is None:
+        return jsonify({'success': False, 'msg': 'Invalid arguments'})
+    return jsonify(node.aggregate(payload.get('from'), payload.get('to'), int(payload['limit']),
+                                  float(payload['budget'])))
 
 
 @app.route('/photon/<int:key>/graph', methods=['GET'])
 def get_photon_graph(key: int):
     """Get photon graph
 
-    Retrieve a page where all photon data stored locally at a node is represented as a graph
+    Retrieve a page where the photon data stored locally at a node is represented as a graph. Long histories are
+    summarised from the rollups, such that the graph has a bounded number of points.
 
     :param key: the key of the photon.
+    :param from: optional, only measurements dated at or after this epoch ms.
+    :param to: optional, only measurements dated before this epoch ms.
+    :param points: optional, the maximum number of points in the graph, default GRAPH_POINTS.
     :returns: {'success': False, 'msg': 'No data for this photon key'} or html-page with the photon data plotted as a graph
     """
-    result = node.get_photon_data(key)
+    result = node.get_photon_points(key, request.args.get('from', None, type=int),
+                                    request.args.get('to', None, type=int),
+                                    request.args.get('points', GRAPH_POINTS, type=int))
     if result is None:
         return jsonify({'success': False, 'msg': 'No data for this photon key'})
     return render_template('photon_graph.html',
                            node=node,
-                           data=json.loads(result))
+                           key=key,
+                           resolution=result[0],
+                           data=result[1])
 
 
 @app.route('/search', methods=['POST'])
@@ -321,7 +592,8 @@ def search():
     """
     search_form = SearchForm()
     if search_form.validate_on_submit():
-        result_node, msg, count = node.find_successor(int(request.form.get('key')), node.key)
+        result_node, msg, count = node.find_successor(int(request.form.get('key')), node.key,
+                                                      iterative=search_form.iterative.data)
         if result_node is not None:
             output = "{0}:{1}, key={2}, msg={3}, hop count = {4}".format(result_node.ip, result_node.port, result_node.key, msg, count)
         else:
@@ -341,13 +613,76 @@ def search():
 def closest_finger(key):
     """Closest finger
 
-    Report the closest preceding finger.
+    Report the closest preceding finger. This is used as a single hop in iterative lookups, so the response also
+    contains the successor and whether it is responsible for the key.
 
     :param key: the key that is searched for
-    :returns: json response: {'node_ip': ip, 'node_port': port}
+    :returns: json response: {'node_ip': ip, 'node_port': port, 'node_key': key, 'successor_ip': ip,
+    'successor_port': port, 'successor_key': key, 'done': true if the successor is responsible for the key}
     """
     pf = node.closest_preceding_finger(key)
-    return jsonify({'node_ip': pf.ip, 'node_port': pf.port})
+    successor_node = node.successor
+    return jsonify({'node_ip': pf.ip,
+                    'node_port': pf.port,
+                    'node_key': pf.key,
+                    'successor_ip': successor_node.ip,
+                    'successor_port': successor_node.port,
+                    'successor_key': successor_node.key,
+                    'done': in_interval(node.key, successor_node.key, key)})
+
+
+@app.route('/finger_table', methods=['GET'])
+def finger_table():
+    """Finger table
+
+    Return the whole finger table of the node. This is used by joining nodes to fill their own finger table.
+
+    :returns: json response: {'key': node key, 'keys': [finger start, ...], 'fingers': [{'ip': ip, 'port': port, 'key': key} or null, ...]}
+    """
+    fingers = [{'ip': x.ip, 'port': x.port, 'key': x.key} if x is not None else None
+               for x in node.finger_table.fingers]
+    return jsonify({'key': node.key, 'keys': node.finger_table.keys, 'fingers': fingers})
+
+
+@app.route('/lookup/<int:key>', methods=['GET'])
+def lookup(key):
+    """Lookup
+
+    Find the node responsible for a key, starting at this node.
+
+    :param key: the key to search for
+    :param mode: 'recursive' (default) or 'iterative'. Iterative lookups are driven by this node hop by hop.
+    :returns: {'successor': true, 'key': successor.key, 'ip': successor.ip, 'port': successor.port, 'msg': message,
+    'count': hop count, 'hops': per-hop latencies in ms (iterative only)}, otherwise {'successor': false, 'error': error message}
+    """
+    hops = []
+    if request.args.get('mode') == 'iterative':
+        successor_node, msg, count, hops = node.find_successor_iterative(key)
+    else:
+        successor_node, msg, count = node.find_successor(key, node.key)
+    if successor_node:
+        return jsonify({'successor': True,
+                        'key': successor_node.key,
+                        'ip': successor_node.ip,
+                        'port': successor_node.port,
+                        'msg': msg,
+                        'count': count,
+                        'hops': hops})
+    return jsonify({'successor': False, 'error': msg})
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Statistics
+
+    Report runtime counters of the node.
+
+    :returns: json response: {'transport': {'connections_opened': int, 'connections_reused': int, 'timeouts': int, ...},
+    'maintenance': {task: {'interval': float, 'runs': int, 'failures': int, 'last_duration': float, ...}, ...}}
+    """
+    result = node.get_stats()
+    result['maintenance'] = engine.stats()
+    return jsonify(result)
 
 
 @app.route('/api', defaults={'response': 'html'}, methods=['GET'])
@@ -369,19 +704,32 @@ def api(response):
     return render_template('doc.html', endpoints=endpoints)
 
 
-def stabilize():
-    """Stabilize
-    Call stabilize on the node
+def start_maintenance() -> MaintenanceEngine:
+    """Start maintenance
+    Schedule every maintenance task of the node independently, as configured in MAINTENANCE_SCHEDULE.
+    The ring maintenance tasks in ADAPTIVE_TASKS back off while the ring state is unchanged.
     """
-    node.stabilize()
-    node.update_successor_list()
-    node.check_predecessor()
-    node.fix_fingers()
-    node.collect_data()
-    node.poll_data()
-    node.check_backups()
-    sleep(2 + random.uniform(0, 2))
-    executor.submit(stabilize)
+    maintenance = MaintenanceEngine()
+    for name, (interval, jitter, concurrency) in MAINTENANCE_SCHEDULE.items():
+        if name in ADAPTIVE_TASKS:
+            maintenance.add_task(name, getattr(node, name), interval, jitter, concurrency,
+                                 observe=node.ring_state, backoff=ADAPTIVE_BACKOFF, max_interval=ADAPTIVE_MAX_INTERVAL)
+        else:
+            maintenance.add_task(name, getattr(node, name), interval, jitter, concurrency)
+    maintenance.start()
+    return maintenance
+
+
+def shutdown(signum, frame):
+    """Shutdown
+    Leave the network gracefully on SIGTERM/SIGINT. The departure runs in its own thread, as the server must keep
+    answering while the successor pulls the measurements.
+    """
+    def depart():
+        engine.stop()
+        node.depart()
+        os._exit(0)
+    threading.Thread(target=depart, daemon=True).start()
 
 
 if __name__ == '__main__':
@@ -395,22 +743,25 @@ if __name__ == '__main__':
     if port is None:
         port = get_free_port()
 
-    # Clear database
-    con = sql.connect('data/' + str(port) + '.db')
-    con.execute('DROP TABLE IF EXISTS measurement')
-    con.execute('CREATE TABLE measurement (date TEXT, id TEXT, data INTEGER )')
-    con.close()
-
     node = Node(host, port)
+    node.storage = open_storage(port)
+    if CLEAR_STORAGE:
+        node.storage.clear()
     node.successor = node
 
     if join_port:
         node.join(host, join_port)
 
-    executor.submit(stabilize)
+    engine = start_maintenance()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
 
     #app.config['SERVER_NAME'] = host + ":" + str(port)
-    app.run(host=host, port=port, threaded=True)
+    if SERVER_MODE == 'async':
+        from chord.server import AsyncServer
+        AsyncServer(node, app, on_notify=engine.reset).run(host, port)
+    else:
+        app.run(host=host, port=port, threaded=True)
 
 
 #@app.route('/on')
@@ -0,0 +1,83 @@
+import random
+import sys
+import threading
+import unittest
+
+from chord.finger_table import FingerTable
+from chord.util import RING_SIZE, distance, in_interval
+
+
+class Peer:
+    def __init__(self, key: int):
+        self.key = key
+
+
+def linear_closest_preceding_finger(table: FingerTable, key: int):
+    """The closest preceding finger as found by scanning all fingers, as the finger table did before the index"""
+    best = None
+    for node in table.fingers:
+        if node is None or node.key == table.key or not in_interval(table.key, key, node.key):
+            continue
+        if best is None or distance(node.key, key) < distance(best.key, key):
+            best = node
+    return best
+
+
+class FingerTableTest(unittest.TestCase):
+
+    def check_against_linear_scan(self, table: FingerTable, rng: random.Random):
+        for key in [table.key] + [rng.randrange(RING_SIZE) for _ in range(200)]:
+            expected = linear_closest_preceding_finger(table, key)
+            found = table.closest_preceding_finger(key)
+            self.assertEqual(expected.key if expected else None, found.key if found else None)
+
+    def test_closest_preceding_finger_matches_linear_scan(self):
+        rng = random.Random(4)
+        for _ in range(20):
+            table = FingerTable(rng.randrange(RING_SIZE))
+            peers = [Peer(rng.randrange(RING_SIZE)) for _ in range(8)] + [Peer(table.key)]
+            for _ in range(100):
+                table.update_finger(rng.randrange(table.max_i + 1), rng.choice(peers + [None]))
+                self.check_against_linear_scan(table, rng)
+
+    def test_seed_matches_linear_scan(self):
+        rng = random.Random(5)
+        table = FingerTable(rng.randrange(RING_SIZE))
+        table.seed([Peer(rng.randrange(RING_SIZE)) for _ in range(10)])
+        self.check_against_linear_scan(table, rng)
+
+    def test_index_holds_each_finger_node_once(self):
+        table = FingerTable(100)
+        first, second = Peer(200), Peer(5000)
+        for i in range(table.max_i + 1):
+            table.update_finger(i, first if i < 5 else second)
+        self.assertEqual([x.key for x in table.preceding_fingers(99)], [200, 5000])
+        for i in range(5):
+            table.update_finger(i, second)
+        self.assertEqual([x.key for x in table.preceding_fingers(99)], [5000])
+        self.assertEqual(table.preceding_fingers(4999), [])
+
+    def test_concurrent_updates_keep_index_consistent(self):
+        table = FingerTable(100)
+        peers = [Peer(key) for key in (200, 3000, 7000, 9000)]
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            def update(seed):
+                rng = random.Random(seed)
+                for _ in range(5000):
+                    table.update_finger(rng.randrange(2), rng.choice(peers + [None]))
+            threads = [threading.Thread(target=update, args=(seed,)) for seed in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        expected = sorted({x.key for x in table.fingers if x is not None}, key=lambda key: distance(table.key, key))
+        self.assertEqual([x.key for x in table.preceding_fingers(table.key)], expected)
+        self.check_against_linear_scan(table, random.Random(6))
+
+
+if __name__ == '__main__':
+    unittest.main()